@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#coding: utf-8
+"""
+Benchmark of DexcellAsyncSender against a local stand-in of the insert
+endpoint that answers every POST after a fixed latency.
+
+Checks that the inserts run concurrency at a time, that an insert past
+max_pending raises with block=False, and that the server receives the
+same requests from DexcellAsyncSender as from DexcellSender, then
+compares their insert rates.
+
+    python benchmarks/bench_async_sender.py [readings] [latency ms] [concurrency]
+"""
+
+import BaseHTTPServer
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dexma.dexcell import DexcellAsyncSender, DexcellSender, \
+    DexcellServiceMessage
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Records the path, token and body of every request and how many of them
+    were being answered at once
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StandInHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-length') or 0))
+        with server.lock:
+            server.requests.append((self.path,
+                                    self.headers.get('x-dexcell-token'), body))
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        time.sleep(server.latency)
+        with server.lock:
+            server.active -= 1
+        self.send_response(200)
+        self.send_header('Content-length', '0')
+        self.end_headers()
+
+
+def start(latency):
+    server = StandInServer(latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, '127.0.0.1:%d' % server.server_address[1]
+
+
+def messages(count):
+    timestamp = time.gmtime(1388534400)
+    return [DexcellServiceMessage('node%d' % (i % 10), 401, timestamp,
+                                  i * 0.25, i)
+            for i in range(count)]
+
+
+def run_sync(address, inserts):
+    sender = DexcellSender(gateway='gw', server=address, https=False)
+    try:
+        for serviceMessage in inserts:
+            if isinstance(serviceMessage, list):
+                sender.insertDexcellServiceMessages(serviceMessage)
+            else:
+                sender.insertDexcellServiceMessage(serviceMessage)
+    finally:
+        sender.close()
+
+
+def run_async(address, inserts, concurrency):
+    sender = DexcellAsyncSender(gateway='gw', server=address, https=False,
+                                concurrency=concurrency)
+    try:
+        futures = []
+        for serviceMessage in inserts:
+            if isinstance(serviceMessage, list):
+                futures.append(sender.insertDexcellServiceMessages(serviceMessage))
+            else:
+                futures.append(sender.insertDexcellServiceMessage(serviceMessage))
+        results = [future.result() for future in futures]
+    finally:
+        sender.close()
+    if [result[0] for result in results] != [200] * len(inserts):
+        raise SystemExit("async inserts failed: %r" % results)
+
+
+def check_backpressure(address, latency):
+    sender = DexcellAsyncSender(gateway='gw', server=address, https=False,
+                                concurrency=2, max_pending=4)
+    serviceMessage = messages(1)[0]
+    try:
+        futures = [sender.insertDexcellServiceMessage(serviceMessage)
+                   for i in range(4)]
+        try:
+            sender.insertDexcellServiceMessage(serviceMessage, block=False)
+        except Exception:
+            pass
+        else:
+            raise SystemExit("insert past max_pending did not raise")
+        started = time.time()
+        futures.append(sender.insertDexcellServiceMessage(serviceMessage))
+        if time.time() - started < latency / 2:
+            raise SystemExit("insert past max_pending did not block")
+        for future in futures:
+            future.result()
+    finally:
+        sender.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000.0
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    single = messages(count)
+    inserts = single[:count // 2] + [single[i:i + 10]
+                                     for i in range(count // 2, count, 10)]
+
+    server, address = start(latency)
+
+    started = time.time()
+    run_sync(address, inserts)
+    t_sync = time.time() - started
+    sync_requests = server.requests
+    server.requests = []
+    server.peak = 0
+
+    started = time.time()
+    run_async(address, inserts, concurrency)
+    t_async = time.time() - started
+    async_requests = server.requests
+
+    if sorted(async_requests) != sorted(sync_requests):
+        raise SystemExit("async requests differ from DexcellSender")
+    if server.peak != concurrency:
+        raise SystemExit("%d inserts in flight at most, expected %d"
+                         % (server.peak, concurrency))
+    check_backpressure(address, latency)
+    server.shutdown()
+
+    print "%d inserts, %d ms latency" % (len(inserts), latency * 1000)
+    print "DexcellSender:                %8.1f inserts/s" % (len(inserts) / t_sync)
+    print "DexcellAsyncSender (%2d):      %8.1f inserts/s (%.1fx)" % (
+        concurrency, len(inserts) / t_async, t_sync / t_async)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#coding: utf-8
+"""
+Microbenchmark of the insert payload serialization.
+
+Compares the original dict + time.strftime + json.dumps path with
+DexcellReadingEncoder, over DexcellServiceMessages and over a
+DexcellServiceMessageBatch, and checks that all produce the same bytes.
+
+    python benchmarks/bench_serialization.py [readings]
+"""
+
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dexma.dexcell import DexcellReadingEncoder, DexcellServiceMessage, \
+    DexcellServiceMessageBatch
+
+
+def dict_payload(gateway, serviceMessages, timezone='UTC', extraparams={}):
+    readings = []
+    for serviceMessage in serviceMessages:
+        reading = {
+            'nodeNetworkId': str(serviceMessage.node),
+            'serviceNetworkId': int(serviceMessage.service),
+            'value': float(serviceMessage.value),
+            'seqNum': int(serviceMessage.seqnum),
+            'timeStamp': time.strftime("%Y-%m-%dT%H:%M:%S.000 " + timezone,
+                                       serviceMessage.timestamp)
+        }
+        readings.append(reading)
+    data = {
+        'gatewayId': gateway,
+        'service': readings
+    }
+    for key in extraparams.keys():
+        data[key] = extraparams[key]
+    return json.dumps(data)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    start = 1400000000
+    messages = [DexcellServiceMessage(node='node%d' % (i % 20),
+                                      service=401 + i % 3,
+                                      timestamp=time.gmtime(start + i // 20),
+                                      value=i * 0.37, seq=i)
+                for i in range(count)]
+    batch = DexcellServiceMessageBatch(messages)
+    encoder = DexcellReadingEncoder()
+    expected = dict_payload('gateway', messages, extraparams={'x': 1})
+    if encoder.encode('gateway', messages, extraparams={'x': 1}) != expected:
+        raise SystemExit("encoder output differs from json.dumps")
+    if encoder.encode('gateway', batch, extraparams={'x': 1}) != expected:
+        raise SystemExit("batch encoder output differs from json.dumps")
+
+    repeat = 5
+    t_dict = min(timeit.repeat(lambda: dict_payload('gateway', messages),
+                               number=1, repeat=repeat))
+    t_enc = min(timeit.repeat(lambda: encoder.encode('gateway', messages),
+                              number=1, repeat=repeat))
+    t_batch = min(timeit.repeat(lambda: encoder.encode('gateway', batch),
+                                number=1, repeat=repeat))
+    print "%d readings" % count
+    print "dict + json.dumps:      %8.1f ms" % (t_dict * 1000)
+    print "DexcellReadingEncoder:  %8.1f ms (%.1fx)" % (t_enc * 1000,
+                                                       t_dict / t_enc)
+    print "encoder over batch:     %8.1f ms (%.1fx)" % (t_batch * 1000,
+                                                       t_dict / t_batch)
+
+
+if __name__ == '__main__':
+    main()
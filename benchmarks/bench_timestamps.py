@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#coding: utf-8
+"""
+Microbenchmark of the readings timestamp decoding.
+
+Compares the original datetime.strptime conversion of the ts and tsutc
+strings of every reading with DexcellRestApi._parse_readings, returning
+datetimes and epoch seconds, and the original regex + strptime
+_datetime_parser with the current one, checking that all agree.
+
+    python benchmarks/bench_timestamps.py [readings]
+"""
+
+import calendar
+import copy
+import json
+import os
+import re
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dexma.dexcell import DexcellRestApi
+
+
+def strptime_readings(readings):
+    for i in range(0, len(readings)):
+        try:
+            readings[i]['ts'] = datetime.strptime(readings[i]['ts'], "%Y-%m-%d %H:%M:%S")
+            readings[i]['tsutc'] = datetime.strptime(readings[i]['tsutc'], "%Y-%m-%d %H:%M:%S")
+        except KeyError:
+            pass
+    return readings
+
+
+def strptime_datetime_parser(dct):
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+    for k, v in dct.items():
+        if isinstance(v, basestring) and re.search("\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}", v):
+            try:
+                dct[k] = datetime.strptime(v, DATE_FORMAT)
+            except ValueError:
+                pass
+    return dct
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 35040
+    start = datetime(2014, 1, 1)
+    readings = []
+    for i in range(count):
+        ts = start + timedelta(minutes=15 * i)
+        readings.append({'ts': ts.strftime("%Y-%m-%d %H:%M:%S"),
+                         'tsutc': (ts - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S"),
+                         'v': i * 0.25})
+    document = json.dumps([{'id': i, 'name': 'device %d' % i,
+                            'created': (start + timedelta(seconds=97 * i)).strftime("%Y-%m-%dT%H:%M:%S")}
+                           for i in range(count)])
+    api = DexcellRestApi('http://localhost', 'token')
+
+    expected = strptime_readings(copy.deepcopy(readings))
+    if api._parse_readings(copy.deepcopy(readings)) != expected:
+        raise SystemExit("decoded datetimes differ from strptime")
+    epochs = api._parse_readings(copy.deepcopy(readings), epoch=True)
+    if [r['tsutc'] for r in epochs] != [calendar.timegm(r['tsutc'].timetuple()) for r in expected]:
+        raise SystemExit("decoded epochs differ from strptime")
+    if json.loads(document, object_hook=api._datetime_parser) != \
+            json.loads(document, object_hook=strptime_datetime_parser):
+        raise SystemExit("_datetime_parser differs from strptime")
+
+    repeat = 5
+
+    def timed(func):
+        copies = [copy.deepcopy(readings) for i in range(repeat)]
+        return min(timeit.repeat(lambda: func(copies.pop()), number=1, repeat=repeat))
+
+    t_strptime = timed(strptime_readings)
+    t_fast = timed(api._parse_readings)
+    t_epoch = timed(lambda r: api._parse_readings(r, epoch=True))
+    t_parser_old = min(timeit.repeat(lambda: json.loads(document, object_hook=strptime_datetime_parser),
+                                     number=1, repeat=repeat))
+    t_parser_new = min(timeit.repeat(lambda: json.loads(document, object_hook=api._datetime_parser),
+                                     number=1, repeat=repeat))
+    print "%d readings" % count
+    print "strptime:               %8.1f ms" % (t_strptime * 1000)
+    print "_parse_readings:        %8.1f ms (%.1fx)" % (t_fast * 1000, t_strptime / t_fast)
+    print "_parse_readings epoch:  %8.1f ms (%.1fx)" % (t_epoch * 1000, t_strptime / t_epoch)
+    print "re + strptime parser:   %8.1f ms" % (t_parser_old * 1000)
+    print "_datetime_parser:       %8.1f ms (%.1fx)" % (t_parser_new * 1000, t_parser_old / t_parser_new)
+
+
+if __name__ == '__main__':
+    main()
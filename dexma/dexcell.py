@@ -27,13 +27,35 @@
 #SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import base64
+import calendar
+import collections
+import copy
+import hashlib
+import heapq
 import httplib
 import json
+import json.encoder
 import logging
+import os
+import Queue
+import random
 import re
+import socket
+import sqlite3
+import threading
 import time
+import urllib
 import urllib2
-from datetime import datetime
+import urlparse
+import warnings
+import zlib
+# imported before datetime.strptime is first called from worker threads
+import _strptime
+from array import array
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from itertools import izip
 
 
 try:
@@ -45,14 +67,274 @@ except ImportError:
     logging.NullHandler = NullHandler
     from logging import NullHandler
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# array typecode holding 64 bit integers, double where long is 32 bit
+_INT64_TYPECODE = 'l' if array('l').itemsize == 8 else 'd'
+
+
+def _imap_unordered(func, iterable, workers):
+    """Yield (item, result, error) for every item of iterable as soon as
+    func(item) completes in one of workers threads. Items are taken from
+    iterable lazily, never more than two per worker ahead of the results.
+    """
+    workers = max(1, int(workers))
+    if workers == 1:
+        for item in iterable:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+    stop = object()
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is stop:
+                return
+            try:
+                results.put((item, func(item), None))
+            except Exception as e:
+                results.put((item, None, e))
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    iterator = iter(iterable)
+    exhausted = False
+    pending = 0
+    try:
+        while True:
+            while not exhausted and pending < 2 * workers:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                tasks.put(item)
+                pending += 1
+            if pending == 0:
+                break
+            yield results.get()
+            pending -= 1
+    finally:
+        for thread in threads:
+            tasks.put(stop)
+    # every worker is idle once all the results were taken, so they are
+    # waited for; an iterator closed early leaves its busy workers behind
+    for thread in threads:
+        thread.join()
+
+
+_INFINITY = float('inf')
+_NAN = float('nan')
+
+
+def _json_float(value):
+    """Encode a float exactly as json.dumps does
+    """
+    if value != value:
+        return 'NaN'
+    if value == _INFINITY:
+        return 'Infinity'
+    if value == -_INFINITY:
+        return '-Infinity'
+    return repr(value)
+
+
+class DexcellConnectionPool(object):
+    """
+    A small pool of persistent HTTP/1.1 connections to a single server.
+
+    Idle connections are kept for idle_timeout seconds and at most size of
+    them are kept open. A connection the server has closed in the meantime
+    is replaced transparently the next time it is used. With tunnel, a
+    (host, port, headers) tuple, server is a proxy the connections go
+    through with a CONNECT to host and port.
+    """
+
+    def __init__(self, server, https=True, timeout=30.0, size=2,
+                 idle_timeout=60.0, port=None, tunnel=None):
+        self.server = server
+        self.https = https
+        self.port = port
+        self.tunnel = tunnel
+        self.timeout = timeout
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def __newConnection(self):
+        if self.https:
+            conn = httplib.HTTPSConnection(self.server, self.port,
+                                           timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.server, self.port,
+                                          timeout=self.timeout)
+        if self.tunnel is not None:
+            host, port, headers = self.tunnel
+            conn.set_tunnel(host, port, dict(headers))
+        return conn
+
+    def __getConnection(self):
+        """Return (connection, reused) with the freshest idle connection
+        """
+        expired = []
+        conn = None
+        now = time.time()
+        with self.__lock:
+            while self.__idle:
+                candidate, last_used = self.__idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self.__newConnection(), False
+
+    def __releaseConnection(self, conn):
+        with self.__lock:
+            if len(self.__idle) < self.size:
+                self.__idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def open(self, method, url, body=None, headers={}):
+        """Send a request and return the response unread. Its connection
+        goes back to the pool when the response is passed to release
+        """
+        conn, reused = self.__getConnection()
+        sent = False
+        try:
+            try:
+                conn.request(method, url, body, headers)
+                sent = True
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                # only an idle connection the server dropped before reading
+                # the request is retried, a request that may have been
+                # processed is left to the caller
+                if not reused or (sent and not self.__closedUnanswered(e)):
+                    raise
+                conn.close()
+                conn = self.__newConnection()
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        response.connection = conn
+        return response
+
+    def __closedUnanswered(self, error):
+        """Whether error is the server closing without sending a status line
+        """
+        if not isinstance(error, httplib.BadStatusLine):
+            return False
+        return error.line in ('', "''") or \
+            error.line.startswith('No status line received')
+
+    def release(self, response):
+        """Give back the connection of a response returned by open, closing
+        it instead if the response was not read completely
+        """
+        if response.will_close or not response.isclosed():
+            response.connection.close()
+        else:
+            self.__releaseConnection(response.connection)
+
+    def request(self, method, url, body=None, headers={}):
+        """Send a request and return the response with its body already read
+        """
+        response = self.open(method, url, body, headers)
+        try:
+            response.body = response.read()
+        except:
+            response.connection.close()
+            raise
+        self.release(response)
+        return response
+
+    def close(self):
+        """Close every idle connection of the pool
+        """
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = []
+        for conn, last_used in idle:
+            conn.close()
+
+
+class DexcellTokenBucket(object):
+    """
+    A token bucket allowing rate operations per second with bursts of up to
+    capacity operations
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.__tokens = self.capacity
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def configure(self, rate, capacity=None):
+        """Change the rate and capacity, keeping the tokens left
+        """
+        with self.__lock:
+            self.rate = float(rate)
+            self.capacity = float(capacity if capacity is not None else rate)
+            self.__tokens = min(self.__tokens, self.capacity)
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket, returning False if there are not
+        enough of them
+        """
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(self.capacity, self.__tokens +
+                                (now - self.__last) * self.rate)
+            self.__last = now
+            if self.__tokens < tokens:
+                return False
+            self.__tokens -= tokens
+            return True
+
 
 class DexcellLoggingHandler(logging.Handler):
     """
     A class which sends records to a DEXCell Energy manager server,
+
+    Identical (level, module, name, msg) records within collapse_window
+    seconds are sent once, followed by a single record with the repeat
+    count when the window closes. With rate set, the records of each
+    gateway are limited by a token bucket of rate records per second and
+    bursts of burst records. A handler created with another rate or burst
+    reconfigures the bucket of every open handler of its gateway, and the
+    bucket is dropped once all of them are closed.
     """
 
+    # [token bucket, open handlers] shared by the handlers of each gateway
+    buckets = {}
+    buckets_lock = threading.Lock()
+
     def __init__(self, gateway, token, host='www.dexcell.com', port=0,
-                 url='/api/v2/gateway/log/set/', https=True):
+                 url='/api/v2/gateway/log/set/', https=True,
+                 collapse_window=0, rate=None, burst=None):
         """
         Initialize the instance with the host, the request URL and token
         """
@@ -69,6 +351,33 @@ class DexcellLoggingHandler(logging.Handler):
             else:
                 port = 80
         self.port = port
+        if ":" in host:
+            port = None                                                     # host carries its own port
+        self.pool = DexcellConnectionPool(host, https, timeout=10.0, size=1,
+                                          port=port)
+        self.collapse_window = collapse_window
+        self.collapsed = 0
+        self.ratelimited = 0
+        self.__repeats = {}
+        self.__repeats_lock = threading.Lock()
+        self.bucket = None
+        if rate is not None:
+            with DexcellLoggingHandler.buckets_lock:
+                shared = DexcellLoggingHandler.buckets.get(gateway)
+                if shared is None:
+                    shared = [DexcellTokenBucket(rate, burst), 0]
+                    DexcellLoggingHandler.buckets[gateway] = shared
+                elif (shared[0].rate, shared[0].capacity) != \
+                        (float(rate), float(burst if burst is not None else rate)):
+                    previous = (shared[0].rate, shared[0].capacity)
+                    shared[0].configure(rate, burst)
+                    warnings.warn('rate limit of the handlers of gateway %s changed from %s to %s '
+                                  'records per second, bursts from %s to %s' %
+                                  (gateway, previous[0], shared[0].rate, previous[1],
+                                   shared[0].capacity))
+                shared[1] += 1
+                self.bucket = shared[0]
+        self.__holdsBucket = self.bucket is not None
 
     def mapLogRecord(self, record):
         """
@@ -78,6 +387,89 @@ class DexcellLoggingHandler(logging.Handler):
         """
         return record.__dict__
 
+    def dexcellMessage(self, record, repeated=0):
+        """
+        Return the JSON message sent to the server for a record
+        """
+        recorddict = record.__dict__
+        name = recorddict['name']
+        msg = recorddict['msg']
+        if repeated:
+            msg = "%s (repeated %d times)" % (msg, repeated)
+        level = recorddict['levelname']
+        module = recorddict['module']
+        ts = time.gmtime(recorddict['created'])
+        dexcellmsgdict = {}
+        dexcellmsgdict['level'] = level
+        dexcellmsgdict['message'] = "%s - %s - %s" % (module, name, msg)
+        dexcellmsgdict['tz'] = 'UTC'
+        dexcellmsgdict['ts'] = time.strftime('%Y%m%d%H%M%S', ts)
+        return json.dumps(dexcellmsgdict)
+
+    def send(self, jsondexcellmsg):
+        """
+        Send a JSON message to the server over the persistent connection
+        """
+        host = self.host
+        url = self.url + self.gateway
+        # support multiple hosts on one IP address...
+        # need to strip optional :port from host, if present
+        i = host.find(":")
+        if i >= 0:
+            host = host[:i]
+        headers = {
+            "Host": host,
+            "Content-type": "application/json",
+            "Content-length": str(len(jsondexcellmsg)),
+            'x-dexcell-token': str(self.token)
+        }
+        self.pool.request(self.method, url, jsondexcellmsg, headers)    # can't do anything with the result
+
+    def filterRecord(self, record):
+        """
+        Return the JSON messages to send for a record once duplicates are
+        collapsed and the rate limit applied, preceded by the repeat counts
+        of the collapse windows that have closed
+        """
+        messages = self.collapsedSummaries(record.created)
+        if self.collapse_window > 0:
+            recorddict = record.__dict__
+            key = (recorddict['levelname'], recorddict['module'],
+                   recorddict['name'], recorddict['msg'])
+            with self.__repeats_lock:
+                repeat = self.__repeats.get(key)
+                if repeat is not None:
+                    repeat[1] += 1
+                    repeat[2] = record
+                    self.collapsed += 1
+                    return messages
+                if self.bucket is not None and not self.bucket.consume():
+                    self.ratelimited += 1
+                    return messages
+                # only a record that is sent opens a collapse window
+                self.__repeats[key] = [record.created, 0, record]
+        elif self.bucket is not None and not self.bucket.consume():
+            self.ratelimited += 1
+            return messages
+        messages.append(self.dexcellMessage(record))
+        return messages
+
+    def collapsedSummaries(self, now=None):
+        """
+        Return the repeat count messages of the collapse windows closed at
+        now, or of every window if now is None
+        """
+        messages = []
+        if not self.__repeats:
+            return messages
+        with self.__repeats_lock:
+            for key, (first, repeated, record) in self.__repeats.items():
+                if now is None or now - first >= self.collapse_window:
+                    del self.__repeats[key]
+                    if repeated:
+                        messages.append(self.dexcellMessage(record, repeated))
+        return messages
+
     def emit(self, record):
         """
         Emit a record.
@@ -85,45 +477,155 @@ class DexcellLoggingHandler(logging.Handler):
         Send the record to the Web server as a percent-encoded dictionary
         """
         try:
-            recorddict = record.__dict__
-            name = recorddict['name']
-            msg = recorddict['msg']
-            level = recorddict['levelname']
-            module = recorddict['module']
-            ts = time.gmtime(recorddict['created'])
-            dexcellmsgdict = {}
-            dexcellmsgdict['level'] = level
-            dexcellmsgdict['message'] = "%s - %s - %s" % (module, name, msg)
-            dexcellmsgdict['tz'] = 'UTC'
-            dexcellmsgdict['ts'] = time.strftime('%Y%m%d%H%M%S', ts)
-            jsondexcellmsg = json.dumps(dexcellmsgdict)
-            host = self.host
-            port = self.port
-            if self.https:
-                h = httplib.HTTPSConnection(host, port, timeout=10.0)
-            else:
-                h = httplib.HTTPConnection(host, port, timeout=10.0)
-            url = self.url + self.gateway
-            # support multiple hosts on one IP address...
-            # need to strip optional :port from host, if present
-            i = host.find(":")
-            if i >= 0:
-                host = host[:i]
-            headers = {
-                "Host": host,
-                "Content-type": "application/json",
-                "Content-length": str(len(jsondexcellmsg)),
-                'x-dexcell-token': str(self.token)
-            }
-            h.request(self.method, url, jsondexcellmsg, headers)
-            h.getresponse()                                                     # can't do anything with the result
+            for jsondexcellmsg in self.filterRecord(record):
+                self.send(jsondexcellmsg)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def close(self):
+        """
+        Send the pending repeat counts and close the connection to the
+        server
+        """
+        try:
+            for jsondexcellmsg in self.collapsedSummaries():
+                self.send(jsondexcellmsg)
+        except Exception:
+            pass
+        self.pool.close()
+        with DexcellLoggingHandler.buckets_lock:
+            shared = DexcellLoggingHandler.buckets.get(self.gateway)
+            if self.__holdsBucket and shared is not None and shared[0] is self.bucket:
+                shared[1] -= 1
+                if not shared[1]:
+                    del DexcellLoggingHandler.buckets[self.gateway]
+            self.__holdsBucket = False
+        logging.Handler.close(self)
+
+
+class DexcellQueueLoggingHandler(DexcellLoggingHandler):
+    """
+    A DexcellLoggingHandler whose emit only queues the record.
+
+    A background thread ships the queued records over a persistent
+    connection, draining every record queued since its last pass in one go.
+    At most capacity records are queued; past that either the oldest queued
+    record or the new one is dropped, depending on overflow.
+    """
+
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+
+    def __init__(self, gateway, token, host='www.dexcell.com', port=0,
+                 url='/api/v2/gateway/log/set/', https=True,
+                 collapse_window=0, rate=None, burst=None, capacity=1000,
+                 overflow=DROP_OLDEST):
+        DexcellLoggingHandler.__init__(self, gateway, token, host, port, url,
+                                       https, collapse_window, rate, burst)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.__queue = collections.deque()
+        self.__sending = 0
+        self.__closing = False
+        self.__cond = threading.Condition()
+        self.__thread = threading.Thread(target=self.__ship,
+                                         name='DexcellQueueLoggingHandler')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def emit(self, record):
+        """
+        Queue a record, dropping one if the queue is full
+        """
+        try:
+            messages = self.filterRecord(record)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
+            return
+        self.__enqueue(messages)
+
+    def __enqueue(self, messages):
+        with self.__cond:
+            for jsondexcellmsg in messages:
+                if len(self.__queue) >= self.capacity:
+                    self.dropped += 1
+                    if self.overflow == self.DROP_NEWEST:
+                        continue
+                    self.__queue.popleft()
+                self.__queue.append(jsondexcellmsg)
+            self.__cond.notify_all()
+
+    def __ship(self):
+        while True:
+            if self.collapse_window > 0:
+                self.__enqueue(self.collapsedSummaries(time.time()))
+            with self.__cond:
+                while not self.__queue and not self.__closing:
+                    if self.collapse_window > 0:
+                        self.__cond.wait(self.collapse_window)
+                        break
+                    self.__cond.wait()
+                if not self.__queue:
+                    if self.__closing:
+                        return
+                    continue
+                batch = list(self.__queue)
+                self.__queue.clear()
+                self.__sending = len(batch)
+            for jsondexcellmsg in batch:
+                try:
+                    self.send(jsondexcellmsg)
+                    self.sent += 1
+                except Exception:
+                    self.failed += 1
+            with self.__cond:
+                self.__sending = 0
+                self.__cond.notify_all()
+
+    def flush(self, timeout=30.0):
+        """
+        Wait up to timeout seconds until the queued records have been
+        shipped
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__cond:
+            while self.__queue or self.__sending:
+                if deadline is None:
+                    self.__cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    self.__cond.wait(remaining)
+
+    def close(self, timeout=30.0):
+        """
+        Ship the queued records and stop the background thread
+        """
+        self.__enqueue(self.collapsedSummaries())
+        with self.__cond:
+            self.__closing = True
+            self.__cond.notify_all()
+        self.__thread.join(timeout)
+        DexcellLoggingHandler.close(self)
 
 
 class DexcellServiceMessage(object):
+    """
+    A single reading of a service.
+
+    The timestamp is kept as seconds since the epoch of its fields (as
+    calendar.timegm computes them) and the struct_time is only built when
+    it is read. Messages hash and order by (node, service, timestamp,
+    seqnum), so buffers can be sorted and deduplicated cheaply.
+    """
 
     # AMBIENT
     SERVICE_TEMPERATURE = 301                   # ºC
@@ -183,6 +685,8 @@ class DexcellServiceMessage(object):
     SERVICE_WATER_VOLUME = 901                  # m^3
     SERVICE_WATER_FLOW = 902                    # (m^3)/h
 
+    __slots__ = ('node', 'service', 'epoch', 'value', 'seqnum', '_timestamp')
+
     def __init__(self, node, service, timestamp, value, seq):
         try:
             self.node = str(node)
@@ -193,6 +697,34 @@ class DexcellServiceMessage(object):
         except Exception as e:
             raise Exception("Problem creating DexcellServiceMessage " + e.message)
 
+    @property
+    def timestamp(self):
+        """The timestamp as a struct_time, computed from epoch when needed
+        """
+        if self._timestamp is None:
+            self._timestamp = time.gmtime(self.epoch)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        """Set the timestamp from a struct_time or seconds since the epoch
+        """
+        if isinstance(timestamp, (int, long, float)):
+            self.epoch = int(timestamp)
+        else:
+            self.epoch = calendar.timegm(timestamp)
+        self._timestamp = None
+
+    def __getstate__(self):
+        return (self.node, self.service, self.epoch, self.value, self.seqnum)
+
+    def __setstate__(self, state):
+        self.node, self.service, self.epoch, self.value, self.seqnum = state
+        self._timestamp = None
+
+    def __key(self):
+        return (self.node, self.service, self.epoch, self.seqnum)
+
     def __repr__(self):
         timeformat = "%Y/%m/%d %H:%M"
         outPut = "DexcellServiceMessage(node=%s" % str(self.node)
@@ -202,28 +734,796 @@ class DexcellServiceMessage(object):
         outPut += ", seqnum=%s)" % str(self.seqnum)
         return outPut
 
+    def __hash__(self):
+        return hash(self.__key())
+
     def __eq__(self, other):
         if not isinstance(other, DexcellServiceMessage):
             return False
-        e1 = self.node == other.node
-        e2 = self.service == other.service
-        e3 = self.timestamp == other.timestamp
-        e4 = self.value == other.value
-        e5 = self.seqnum == other.seqnum
-        return e1 and e2 and e3 and e4 and e5
+        return self.__key() == other.__key() and self.value == other.value
 
     def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        if not isinstance(other, DexcellServiceMessage):
+            return NotImplemented
+        return self.__key() < other.__key()
+
+    def __le__(self, other):
+        if not isinstance(other, DexcellServiceMessage):
+            return NotImplemented
+        return self.__key() <= other.__key()
+
+    def __gt__(self, other):
         if not isinstance(other, DexcellServiceMessage):
+            return NotImplemented
+        return self.__key() > other.__key()
+
+    def __ge__(self, other):
+        if not isinstance(other, DexcellServiceMessage):
+            return NotImplemented
+        return self.__key() >= other.__key()
+
+
+class _DexcellServiceMessageView(object):
+    """
+    A DexcellServiceMessage compatible view of one row of a
+    DexcellServiceMessageBatch
+    """
+
+    __slots__ = ('_batch', '_index')
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    @property
+    def node(self):
+        return self._batch.nodeTable[self._batch.nodes[self._index]]
+
+    @property
+    def service(self):
+        return self._batch.services[self._index]
+
+    @property
+    def epoch(self):
+        return int(self._batch.timestamps[self._index])
+
+    @property
+    def timestamp(self):
+        return time.gmtime(self.epoch)
+
+    @property
+    def value(self):
+        return self._batch.values[self._index]
+
+    @property
+    def seqnum(self):
+        return int(self._batch.seqnums[self._index])
+
+    def __repr__(self):
+        timeformat = "%Y/%m/%d %H:%M"
+        outPut = "DexcellServiceMessage(node=%s" % str(self.node)
+        outPut += ", service=%s" % str(self.service)
+        outPut += ", timestamp=%s" % time.strftime(timeformat, self.timestamp)
+        outPut += ", value=%s" % str(self.value)
+        outPut += ", seqnum=%s)" % str(self.seqnum)
+        return outPut
+
+
+class DexcellServiceMessageBatch(object):
+    """
+    A columnar container of readings.
+
+    Node ids are interned in nodeTable and every reading is kept as one
+    row of the parallel typed arrays nodes, services, timestamps, values and
+    seqnums. Timestamps are the timestamp fields as seconds since the epoch
+    (as calendar.timegm computes them). Iterating the batch yields
+    DexcellServiceMessage compatible views.
+    """
+
+    def __init__(self, serviceMessages=()):
+        self.nodeTable = []
+        self.__nodeIndex = {}
+        # slices share the node table of their batch until they add a node
+        self.__sharedNodes = False
+        self.nodes = array('i')
+        self.services = array('i')
+        self.timestamps = array(_INT64_TYPECODE)
+        self.values = array('d')
+        self.seqnums = array(_INT64_TYPECODE)
+        self.extend(serviceMessages)
+
+    def __nodeId(self, node):
+        node = str(node)
+        index = self.__nodeIndex.get(node)
+        if index is None:
+            if self.__sharedNodes:
+                self.nodeTable = list(self.nodeTable)
+                self.__nodeIndex = dict(self.__nodeIndex)
+                self.__sharedNodes = False
+            index = self.__nodeIndex[node] = len(self.nodeTable)
+            self.nodeTable.append(node)
+        return index
+
+    def append(self, node, service, timestamp, value, seq):
+        """Append a reading. timestamp is a struct_time or seconds since the
+        epoch
+        """
+        if not isinstance(timestamp, (int, long, float)):
+            timestamp = calendar.timegm(timestamp)
+        self.nodes.append(self.__nodeId(node))
+        self.services.append(int(service))
+        self.timestamps.append(int(timestamp))
+        self.values.append(float(value))
+        self.seqnums.append(int(seq))
+
+    def appendMessage(self, serviceMessage):
+        """Append a DexcellServiceMessage
+        """
+        timestamp = getattr(serviceMessage, 'epoch', None)
+        if timestamp is None:
+            timestamp = serviceMessage.timestamp
+        self.append(serviceMessage.node, serviceMessage.service, timestamp,
+                    serviceMessage.value, serviceMessage.seqnum)
+
+    def extend(self, serviceMessages):
+        """Append every DexcellServiceMessage of an iterable
+        """
+        if isinstance(serviceMessages, DexcellServiceMessageBatch):
+            nodeIds = [self.__nodeId(node)
+                       for node in serviceMessages.nodeTable]
+            self.nodes.extend(array('i', [nodeIds[i] for i in
+                                          serviceMessages.nodes]))
+            self.services.extend(serviceMessages.services)
+            self.timestamps.extend(serviceMessages.timestamps)
+            self.values.extend(serviceMessages.values)
+            self.seqnums.extend(serviceMessages.seqnums)
+            return
+        for serviceMessage in serviceMessages:
+            self.appendMessage(serviceMessage)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            batch = DexcellServiceMessageBatch()
+            batch.nodeTable = self.nodeTable
+            batch.__nodeIndex = self.__nodeIndex
+            batch.__sharedNodes = self.__sharedNodes = True
+            batch.nodes = self.nodes[index]
+            batch.services = self.services[index]
+            batch.timestamps = self.timestamps[index]
+            batch.values = self.values[index]
+            batch.seqnums = self.seqnums[index]
+            return batch
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('batch index out of range')
+        return _DexcellServiceMessageView(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield _DexcellServiceMessageView(self, index)
+
+    def columns(self):
+        """Return a dict with the node, service, timestamp, value and seqnum
+        columns, as NumPy arrays when NumPy is installed
+        """
+        nodes = [self.nodeTable[i] for i in self.nodes]
+        if numpy is None:
+            return {'node': nodes, 'service': self.services,
+                    'timestamp': self.timestamps, 'value': self.values,
+                    'seqnum': self.seqnums}
+        return {'node': numpy.array(nodes),
+                'service': numpy.array(self.services, dtype=numpy.int32),
+                'timestamp': numpy.array(self.timestamps, dtype=numpy.int64),
+                'value': numpy.array(self.values, dtype=numpy.float64),
+                'seqnum': numpy.array(self.seqnums, dtype=numpy.int64)}
+
+
+class DexcellReadingEncoder(object):
+    """
+    Serializes DexcellServiceMessages straight into insert payloads.
+
+    The output is byte-identical to json.dumps of the reading dicts sent by
+    DexcellSender, but no intermediate dicts are built and the formatted
+    timestamps are cached per second and timezone.
+    """
+
+    CACHE_SIZE = 4096
+    READING_FORMAT = '{"nodeNetworkId": %s, "seqNum": %d, ' \
+                     '"serviceNetworkId": %d, "value": %s, "timeStamp": %s}'
+    __MARKER = '\x00readings\x00'
+    __ENCODED_MARKER = json.dumps(__MARKER)
+
+    def __init__(self):
+        self.__timestamps = {}
+        self.__epochs = {}
+        self.__nodes = {}
+
+    def encodeTimestamp(self, timestamp, timezone):
+        """Return the JSON encoded timeStamp of a reading
+        """
+        timestamps = self.__timestamps.get(timezone)
+        if timestamps is None or len(timestamps) >= self.CACHE_SIZE:
+            timestamps = self.__timestamps[timezone] = {}
+        encoded = timestamps.get(timestamp)
+        if encoded is None:
+            formatted = time.strftime("%Y-%m-%dT%H:%M:%S.000 " + timezone,
+                                      timestamp)
+            encoded = json.encoder.encode_basestring_ascii(formatted)
+            timestamps[timestamp] = encoded
+        return encoded
+
+    def encodeEpoch(self, epoch, timezone):
+        """Return the JSON encoded timeStamp of a reading from the seconds
+        since the epoch of its timestamp fields
+        """
+        epochs = self.__epochs.get(timezone)
+        if epochs is None or len(epochs) >= self.CACHE_SIZE:
+            epochs = self.__epochs[timezone] = {}
+        encoded = epochs.get(epoch)
+        if encoded is None:
+            encoded = self.encodeTimestamp(time.gmtime(epoch), timezone)
+            epochs[epoch] = encoded
+        return encoded
+
+    def encodeNode(self, node):
+        """Return the JSON encoded nodeNetworkId of a reading
+        """
+        encoded = self.__nodes.get(node)
+        if encoded is None:
+            if len(self.__nodes) >= self.CACHE_SIZE:
+                self.__nodes.clear()
+            encoded = json.encoder.encode_basestring_ascii(str(node))
+            self.__nodes[node] = encoded
+        return encoded
+
+    def encodeReading(self, serviceMessage, timezone):
+        """Return the JSON encoded reading of a DexcellServiceMessage
+        """
+        return self.encodeReadings([serviceMessage], timezone)[0]
+
+    def encodeReadings(self, serviceMessages, timezone):
+        """Return a list with the JSON encoded readings of an iterable of
+        DexcellServiceMessages or a DexcellServiceMessageBatch
+        """
+        if isinstance(serviceMessages, DexcellServiceMessageBatch):
+            return self.__encodeBatch(serviceMessages, timezone)
+        epochs = self.__epochs.get(timezone)
+        if epochs is None or len(epochs) >= self.CACHE_SIZE:
+            epochs = self.__epochs[timezone] = {}
+        nodes = self.__nodes
+        encodeTimestamp = self.encodeTimestamp
+        encodeEpoch = self.encodeEpoch
+        encodeNode = self.encodeNode
+        reading_format = self.READING_FORMAT
+        float_repr = float.__repr__
+        readings = []
+        append = readings.append
+        for serviceMessage in serviceMessages:
+            node = nodes.get(serviceMessage.node)
+            if node is None:
+                node = encodeNode(serviceMessage.node)
+            try:
+                epoch = serviceMessage.epoch
+            except AttributeError:
+                timestamp = encodeTimestamp(serviceMessage.timestamp,
+                                            timezone)
+            else:
+                timestamp = epochs.get(epoch)
+                if timestamp is None:
+                    timestamp = encodeEpoch(epoch, timezone)
+            value = float(serviceMessage.value)
+            if value - value == 0:
+                value = float_repr(value)
+            else:
+                value = _json_float(value)
+            append(reading_format % (node, serviceMessage.seqnum,
+                                     serviceMessage.service, value,
+                                     timestamp))
+        return readings
+
+    def __encodeBatch(self, batch, timezone):
+        epochs = self.__epochs.get(timezone)
+        if epochs is None or len(epochs) >= self.CACHE_SIZE:
+            epochs = self.__epochs[timezone] = {}
+        encodeEpoch = self.encodeEpoch
+        nodes = [self.encodeNode(node) for node in batch.nodeTable]
+        reading_format = self.READING_FORMAT
+        float_repr = float.__repr__
+        readings = []
+        append = readings.append
+        for node, service, epoch, value, seqnum in izip(
+                batch.nodes, batch.services, batch.timestamps, batch.values,
+                batch.seqnums):
+            timestamp = epochs.get(epoch)
+            if timestamp is None:
+                timestamp = encodeEpoch(epoch, timezone)
+            if value - value == 0:
+                value = float_repr(value)
+            else:
+                value = _json_float(value)
+            append(reading_format % (nodes[node], seqnum, service, value,
+                                     timestamp))
+        return readings
+
+    def encodePayload(self, gateway, readings, extraparams={}):
+        """Return the insert payload for a list of encoded readings
+        """
+        if 'service' in extraparams:
+            data = {'gatewayId': gateway,
+                    'service': [json.loads(r) for r in readings]}
+            data.update(extraparams)
+            return json.dumps(data)
+        data = {'gatewayId': gateway, 'service': self.__MARKER}
+        data.update(extraparams)
+        return json.dumps(data).replace(self.__ENCODED_MARKER,
+                                        '[' + ', '.join(readings) + ']', 1)
+
+    def encode(self, gateway, serviceMessages, timezone='UTC',
+               extraparams={}):
+        """Return the insert payload for an iterable of
+        DexcellServiceMessages
+        """
+        readings = self.encodeReadings(serviceMessages, timezone)
+        return self.encodePayload(gateway, readings, extraparams)
+
+
+class DexcellSpool(object):
+    """
+    An append-only on-disk spool for insert payloads that could not be sent.
+
+    Payloads are appended one per line to segment files inside directory.
+    The read position is stored in an offset file that is replaced
+    atomically, so after a crash a batch may be replayed twice but is never
+    lost. Once the spool grows over max_bytes the oldest segments are
+    discarded.
+    """
+
+    SEGMENT_FORMAT = 'spool-%016d.log'
+    OFFSET_FILE = 'offset'
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024,
+                 segment_bytes=4 * 1024 * 1024, fsync=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.__lock = threading.RLock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__segments = []
+        for name in os.listdir(directory):
+            if name.startswith('spool-') and name.endswith('.log'):
+                self.__segments.append(int(name[6:-4]))
+        self.__segments.sort()
+        if not self.__segments:
+            self.__segments.append(0)
+            open(self.__segmentPath(0), 'ab').close()
+        self.__repairSegment(self.__segments[-1])
+        self.__offset = self.__loadOffset()
+        self.__pending_bytes = 0
+        self.__pending_payloads = 0
+        for segment, position in self.__iterPendingSegments():
+            with open(self.__segmentPath(segment), 'rb') as f:
+                f.seek(position)
+                for line in f:
+                    self.__pending_bytes += len(line)
+                    self.__pending_payloads += 1
+        self.dropped_payloads = 0
+        self.replayed_payloads = 0
+        self.replayed_readings = 0
+        self.replay_rate = 0.0
+
+    def __segmentPath(self, segment):
+        return os.path.join(self.directory, self.SEGMENT_FORMAT % segment)
+
+    def __repairSegment(self, segment):
+        """Truncate a torn write at the end of a segment
+        """
+        path = self.__segmentPath(segment)
+        with open(path, 'rb') as f:
+            data = f.read()
+        end = data.rfind('\n') + 1
+        if end != len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+
+    def __loadOffset(self):
+        path = os.path.join(self.directory, self.OFFSET_FILE)
+        try:
+            with open(path, 'rb') as f:
+                segment, position = [int(x) for x in f.read().split()]
+        except (IOError, ValueError):
+            return (self.__segments[0], 0)
+        if segment not in self.__segments:
+            return (self.__segments[0], 0)
+        return (segment, position)
+
+    def __storeOffset(self, offset):
+        path = os.path.join(self.directory, self.OFFSET_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write('%d %d\n' % offset)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        self.__offset = offset
+
+    def __iterPendingSegments(self):
+        segment, position = self.__offset
+        for current in self.__segments:
+            if current < segment:
+                continue
+            yield current, (position if current == segment else 0)
+
+    def __dropOldestSegment(self):
+        oldest = self.__segments.pop(0)
+        path = self.__segmentPath(oldest)
+        position = self.__offset[1] if self.__offset[0] == oldest else 0
+        with open(path, 'rb') as f:
+            f.seek(position)
+            for line in f:
+                self.__pending_bytes -= len(line)
+                self.__pending_payloads -= 1
+                self.dropped_payloads += 1
+        os.remove(path)
+        if self.__offset[0] <= oldest:
+            self.__storeOffset((self.__segments[0], 0))
+
+    def append(self, payload):
+        """Append a payload string to the spool
+        """
+        line = payload.replace('\n', ' ') + '\n'
+        with self.__lock:
+            segment = self.__segments[-1]
+            path = self.__segmentPath(segment)
+            if os.path.getsize(path) >= self.segment_bytes:
+                segment += 1
+                self.__segments.append(segment)
+                path = self.__segmentPath(segment)
+            with open(path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            self.__pending_bytes += len(line)
+            self.__pending_payloads += 1
+            while self.__pending_bytes > self.max_bytes and \
+                    len(self.__segments) > 1:
+                self.__dropOldestSegment()
+
+    def read(self, max_payloads=1000):
+        """Return a list of (payload, offset) pairs from the read position
+
+        The read position is not moved until commit() is called with one of
+        the returned offsets.
+        """
+        result = []
+        with self.__lock:
+            for segment, position in self.__iterPendingSegments():
+                with open(self.__segmentPath(segment), 'rb') as f:
+                    f.seek(position)
+                    while len(result) < max_payloads:
+                        line = f.readline()
+                        if not line.endswith('\n'):
+                            break
+                        position += len(line)
+                        result.append((line[:-1], (segment, position)))
+                if len(result) >= max_payloads:
+                    break
+        return result
+
+    def commit(self, offset):
+        """Move the read position to offset, as returned by read()
+        """
+        with self.__lock:
+            if offset <= self.__offset:
+                return
+            for segment, position in self.__iterPendingSegments():
+                if segment > offset[0]:
+                    break
+                end = offset[1] if segment == offset[0] else None
+                with open(self.__segmentPath(segment), 'rb') as f:
+                    f.seek(position)
+                    while end is None or position < end:
+                        line = f.readline()
+                        if not line:
+                            break
+                        position += len(line)
+                        self.__pending_bytes -= len(line)
+                        self.__pending_payloads -= 1
+            self.__storeOffset(offset)
+            while len(self.__segments) > 1 and \
+                    self.__segments[0] < offset[0]:
+                os.remove(self.__segmentPath(self.__segments.pop(0)))
+
+    def recordReplay(self, payloads, readings, seconds):
+        """Account a replayed batch in the throughput statistics
+        """
+        with self.__lock:
+            self.replayed_payloads += payloads
+            self.replayed_readings += readings
+            if seconds > 0:
+                self.replay_rate = readings / seconds
+
+    def pending(self):
+        """Return the number of payloads waiting to be replayed
+        """
+        return self.__pending_payloads
+
+    def stats(self):
+        """Return a dict with the backlog depth and replay throughput
+        """
+        with self.__lock:
+            return {
+                'pending_payloads': self.__pending_payloads,
+                'pending_bytes': self.__pending_bytes,
+                'segments': len(self.__segments),
+                'dropped_payloads': self.dropped_payloads,
+                'replayed_payloads': self.replayed_payloads,
+                'replayed_readings': self.replayed_readings,
+                'replay_rate': self.replay_rate
+            }
+
+
+class DexcellChunkResult(object):
+    """
+    Outcome of one chunk uploaded by insertDexcellServiceMessages.
+    messages keeps the chunk's DexcellServiceMessages only when the insert
+    failed and nothing else will deliver them, so they can be retried.
+    deferred is set instead when the failed payload was spooled or handed
+    to the background retry thread.
+    """
+
+    def __init__(self, index, status, data, count, messages=None,
+                 deferred=False):
+        self.index = index
+        self.status = status
+        self.data = data
+        self.count = count
+        self.messages = messages
+        self.deferred = deferred
+
+    def __repr__(self):
+        return "DexcellChunkResult(index=%d, status=%s, data=%s, count=%d, " \
+            "deferred=%s)" % (self.index, str(self.status), str(self.data),
+                              self.count, self.deferred)
+
+
+class DexcellDeadbandFilter(object):
+    """
+    Send-on-change filter for readings, keyed by (node, service).
+
+    A reading is dropped while its value stays inside the deadband around
+    the last reading sent for the same node and service, unless heartbeat
+    seconds (of reading timestamps) have passed since that one. A deadband
+    is an (absolute, percent) pair where either may be None, and a reading
+    passes when it moves further than any of the two. Services missing from
+    deadbands fall back to DEFAULT_DEADBANDS and then to default, and a
+    deadband of None lets every reading through.
+    """
+
+    S = DexcellServiceMessage
+    DEFAULT_DEADBANDS = {
+        # ambient
+        S.SERVICE_TEMPERATURE: (0.1, None),
+        S.SERVICE_HUMIDITY: (0.5, None),
+        S.SERVICE_LIGHT: (None, 5.0),
+        S.SERVICE_AIR_QUALITY_CO: (None, 2.0),
+        S.SERVICE_AIR_QUALITY_CO2: (None, 2.0),
+        S.SERVICE_SOUND_INTENSITY: (1.0, None),
+        S.SERVICE_SOIL_HUMIDITY: (0.5, None),
+        # cumulative counters, send every increment
+        S.SERVICE_ACTIVE_ENERGY: (0.0, None),
+        S.SERVICE_INDUCTIVE_REACTIVE_ENERGY: (0.0, None),
+        S.SERVICE_CAPACITIVE_REACTIVE_ENERGY: (0.0, None),
+        S.SERVICE_APPARENT_ENERGY: (0.0, None),
+        S.SERVICE_GAS_VOLUME: (0.0, None),
+        S.SERVICE_GAS_ENERGY: (0.0, None),
+        S.SERVICE_FUEL_VOLUME: (0.0, None),
+        S.SERVICE_FUEL_ENERGY: (0.0, None),
+        S.SERVICE_EXP_ACTIVE_ENERGY: (0.0, None),
+        S.SERVICE_EXP_INDUCTIVE_R_ENERGY: (0.0, None),
+        S.SERVICE_EXP_CAPACITIVE_R_ENERGY: (0.0, None),
+        S.SERVICE_PULSE_COUNTER: (0.0, None),
+        S.SERVICE_THERMAL_ENERGY: (0.0, None),
+        S.SERVICE_HOT_WATER_VOLUME: (0.0, None),
+        S.SERVICE_WATER_VOLUME: (0.0, None),
+        # instantaneous electrical values
+        S.SERVICE_ACTIVE_POWER: (None, 1.0),
+        S.SERVICE_INDUCTIVE_REACTIVE_POWER: (None, 1.0),
+        S.SERVICE_CAPACITIVE_REACTIVE_POWER: (None, 1.0),
+        S.SERVICE_APPARENT_POWER: (None, 1.0),
+        S.SERVICE_VOLTAGE: (None, 0.5),
+        S.SERVICE_CURRENT: (None, 1.0),
+        S.SERVICE_NEUTRAL_CURRENT: (None, 1.0),
+        S.SERVICE_AVERAGE_CURRENT: (None, 1.0),
+        S.SERVICE_COS_PHI: (0.01, None),
+        S.SERVICE_POWER_FACTOR: (0.01, None),
+        S.SERVICE_FREQUENCY: (0.05, None),
+        S.SERVICE_THD_VOLTAGE: (0.5, None),
+        S.SERVICE_THD_CURRENT: (0.5, None),
+        # generic and device
+        S.SERVICE_BINARY_INPUT: (0.0, None),
+        S.SERVICE_DEVICE_TEMPERATURE: (0.5, None),
+        # HVAC
+        S.SERVICE_THERMAL_POWER: (None, 1.0),
+        S.SERVICE_MASS_FLOW: (None, 1.0),
+        S.SERVICE_INLET_TEMPERATURE: (0.1, None),
+        S.SERVICE_OUTLET_TEMPERATURE: (0.1, None),
+        S.SERVICE_COP_EER: (0.05, None),
+        S.SERVICE_LOW_PRESSURE: (None, 1.0),
+        S.SERVICE_HIGH_PRESSURE: (None, 1.0),
+        # water
+        S.SERVICE_WATER_FLOW: (None, 1.0),
+    }
+    del S
+
+    def __init__(self, deadbands={}, default=None, heartbeat=900):
+        self.deadbands = dict(self.DEFAULT_DEADBANDS)
+        self.deadbands.update(deadbands)
+        self.default = default
+        self.heartbeat = heartbeat
+        self.dropped = 0
+        self.__last = {}
+        self.__lock = threading.Lock()
+
+    def __accept(self, node, service, epoch, value):
+        deadband = self.deadbands.get(service, self.default)
+        if deadband is None:
             return True
-        e1 = not self.node == other.node
-        e2 = not self.service == other.service
-        e3 = not self.timestamp == other.timestamp
-        e4 = not self.value == other.value
-        e5 = not self.seqnum == other.seqnum
-        return e1 or e2 or e3 or e4 or e5
+        key = (node, service)
+        with self.__lock:
+            last = self.__last.get(key)
+            if last is not None:
+                last_epoch, last_value = last
+                change = abs(value - last_value)
+                absolute, percent = deadband
+                inside = (absolute is None or change <= absolute) and \
+                    (percent is None or
+                     change <= abs(last_value) * percent / 100.0)
+                if inside and epoch - last_epoch < self.heartbeat and \
+                        epoch >= last_epoch:
+                    self.dropped += 1
+                    return False
+            self.__last[key] = (epoch, value)
+        return True
+
+    def accept(self, serviceMessage):
+        """Return True if the reading has to be sent
+        """
+        epoch = getattr(serviceMessage, 'epoch', None)
+        if epoch is None:
+            epoch = calendar.timegm(serviceMessage.timestamp)
+        return self.__accept(str(serviceMessage.node),
+                             int(serviceMessage.service), epoch,
+                             float(serviceMessage.value))
+
+    def filterBatch(self, batch):
+        """Return a new DexcellServiceMessageBatch with the readings of
+        batch that have to be sent
+        """
+        result = DexcellServiceMessageBatch()
+        nodeTable = batch.nodeTable
+        accept = self.__accept
+        for node, service, epoch, value, seqnum in izip(
+                batch.nodes, batch.services, batch.timestamps, batch.values,
+                batch.seqnums):
+            if accept(nodeTable[node], service, epoch, value):
+                result.append(nodeTable[node], service, epoch, value, seqnum)
+        return result
+
+    def reset(self):
+        """Forget the last sent readings, so the next ones always pass
+        """
+        with self.__lock:
+            self.__last.clear()
+
+
+class DexcellRetryPolicy(object):
+    """
+    Exponential backoff with jitter for failed inserts.
+
+    Retry number n (starting at 0) waits base_delay * factor ** n seconds,
+    capped at max_delay and randomized by +/- jitter of its length.
+    """
+
+    def __init__(self, max_retries=5, base_delay=0.5, factor=2.0,
+                 max_delay=30.0, jitter=0.5):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """Return the seconds to wait before retry number attempt
+        """
+        delay = min(self.max_delay, self.base_delay * self.factor ** attempt)
+        delay *= 1 - self.jitter + 2 * self.jitter * random.random()
+        return min(self.max_delay, delay)
+
+
+class DexcellCircuitBreaker(object):
+    """
+    Fails fast while the insert endpoint is down.
+
+    After failure_threshold consecutive failures the circuit opens and
+    inserts are refused without touching the network for reset_timeout
+    seconds. Then one trial insert is let through: its success closes the
+    circuit again and its failure keeps it open for another period.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.__opened = 0
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """Return True if an insert may be attempted now
+        """
+        with self.__lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self.__opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def isOpen(self):
+        """Return True while inserts are being refused
+        """
+        with self.__lock:
+            return self.state == self.OPEN and \
+                time.time() - self.__opened < self.reset_timeout
+
+    def recordSuccess(self):
+        with self.__lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def recordFailure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.__opened = time.time()
 
 
 class DexcellSender(object):
+    """
+    Sends DexcellServiceMessages to the DEXCell insert API.
+
+    Inserts return the (status, data) of the server, (-1, 'FAIL') if it
+    could not be reached and (-1, 'RETRYING') when background_retries is
+    set and the insert was left to the retry thread. Readings dropped by
+    the deadband filter count as sent.
+
+    By default an insert makes a single attempt, so it blocks for at most
+    timeout seconds per connection attempt and request. A retry_policy
+    makes failed inserts retry on the calling thread, adding up to the sum
+    of its delays; with background_retries they are retried by a thread
+    instead, following retry_policy or DexcellRetryPolicy() if none is
+    given.
+    """
 
     DEFAULT_SERVER = 'insert.dexcell.com'
     DEFAULT_URL = '/insert-json.htm'
@@ -235,12 +1535,46 @@ class DexcellSender(object):
     def __init__(self, gateway=DEFAULT_GATEWAY, loggerName=DEFAULT_LOGGERNAME,
                  logfile=DEFAULT_LOGFILE, loglevel=DEFAULT_LOGLEVEL,
                  server=DEFAULT_SERVER, url=DEFAULT_URL,
-                 https=True, timeout=30.0):
+                 https=True, timeout=30.0, pool_size=2, pool_idle_timeout=60.0,
+                 batch_max_readings=1000, batch_max_bytes=512 * 1024,
+                 batch_max_age=5.0, spool=None, retry_policy=None,
+                 circuit_breaker=None, background_retries=False,
+                 deadband=None, compress=False, compress_level=6,
+                 compress_min_size=1024):
         self.__https = https
         self.__server = server
         self.__url = url
         self.__timeout = timeout
         self.__gateway = gateway
+        self.__pool_size = pool_size
+        self.__pool_idle_timeout = pool_idle_timeout
+        self.__pools = {}
+        self.__pools_lock = threading.Lock()
+        self.__encoder = DexcellReadingEncoder()
+        self.__batch_max_readings = batch_max_readings
+        self.__batch_max_bytes = batch_max_bytes
+        self.__batch_max_age = batch_max_age
+        self.__queue = None
+        self.__worker = None
+        self.__worker_lock = threading.Lock()
+        self.__spool = spool
+        self.__replay_lock = threading.Lock()
+        if retry_policy is None:
+            if background_retries:
+                retry_policy = DexcellRetryPolicy()
+            else:
+                retry_policy = DexcellRetryPolicy(max_retries=0)
+        self.__retry_policy = retry_policy
+        self.__breaker = circuit_breaker
+        self.__background_retries = background_retries
+        self.__deadband = deadband
+        self.__compress = compress
+        self.__compress_level = compress_level
+        self.__compress_min_size = compress_min_size
+        self.__retries = []
+        self.__retry_count = 0
+        self.__retry_cond = threading.Condition()
+        self.__retry_thread = None
         self.__logger = logging.getLogger(loggerName)
         if len(self.__logger.handlers) == 0:
             self.__logger.setLevel(loglevel)
@@ -270,82 +1604,907 @@ class DexcellSender(object):
         """
         self.__gateway = gateway
 
+    def close(self):
+        """Send the queued readings, stop the worker thread and close the
+        persistent connections to the server
+        """
+        with self.__worker_lock:
+            worker = self.__worker
+            self.__worker = None
+        if worker is not None:
+            self.__queue.put(self.__STOP)
+            worker.join()
+            self.__queue = None
+        with self.__retry_cond:
+            retry_thread = self.__retry_thread
+            self.__retry_thread = None
+            self.__retry_cond.notify()
+        if retry_thread is not None:
+            retry_thread.join()
+        with self.__pools_lock:
+            pools = self.__pools.values()
+            self.__pools = {}
+        for pool in pools:
+            pool.close()
+
+    def __getPool(self):
+        """Return the connection pool for the current (server, https) pair
+        """
+        key = (self.__server, self.__https)
+        with self.__pools_lock:
+            pool = self.__pools.get(key)
+            if pool is None:
+                pool = DexcellConnectionPool(self.__server, self.__https,
+                                             timeout=self.__timeout,
+                                             size=self.__pool_size,
+                                             idle_timeout=self.__pool_idle_timeout)
+                self.__pools[key] = pool
+        return pool
+
     def __insertRawJSONData(self, data):
-        """Insert the raw data string to the server
+        """Insert the raw data string to the server, spooling it to disk
+        if the server can not be reached
+        """
+        result = self.__postRawJSONData(data)
+        if self.__failed(result):
+            if result[1] != 'RETRYING':
+                self.__spoolFailed(data)
+        elif self.__spool is not None and self.__spool.pending() > 0:
+            self.__startReplay()
+        return result
+
+    def __failed(self, result):
+        return result[0] == -1 or result[0] >= 500
+
+    def __deferred(self, result):
+        """Whether a failed insert was left to the retry thread or spool
+        """
+        if not self.__failed(result):
+            return False
+        return result[1] == 'RETRYING' or self.__spool is not None
+
+    def __spoolFailed(self, data):
+        if self.__spool is not None:
+            self.__spool.append(data)
+            self.__logger.warning("Insert failed, payload spooled")
+        else:
+            self.__logger.error("Insert failed, payload discarded")
+
+    def __startReplay(self):
+        if not self.__replay_lock.acquire(False):
+            return
+        self.__replay_lock.release()
+        replayer = threading.Thread(target=self.replaySpool,
+                                    name='DexcellSender-replay')
+        replayer.daemon = True
+        replayer.start()
+
+    def replaySpool(self, maxReadings=5000):
+        """Send the spooled payloads, merged into batches of up to
+        maxReadings readings. Returns the number of readings replayed
+        """
+        if self.__spool is None:
+            return 0
+        if not self.__replay_lock.acquire(False):
+            return 0
+        replayed = 0
+        try:
+            while True:
+                entries = self.__spool.read()
+                if not entries:
+                    break
+                for data, readings, payloads, offset in \
+                        self.__mergeSpooled(entries, maxReadings):
+                    start = time.time()
+                    result = self.__postOnce(json.dumps(data))
+                    if self.__failed(result):
+                        return replayed
+                    self.__spool.commit(offset)
+                    self.__spool.recordReplay(payloads, readings,
+                                              time.time() - start)
+                    replayed += readings
+        finally:
+            self.__replay_lock.release()
+        return replayed
+
+    def __mergeSpooled(self, entries, maxReadings):
+        """Merge consecutive spooled payloads that share gateway and extra
+        parameters. Yields (data, readings, payloads, offset)
+        """
+        data = None
+        envelope = None
+        payloads = 0
+        offset = None
+        for payload, payload_offset in entries:
+            try:
+                current = json.loads(payload)
+                readings = current.pop('service')
+            except (ValueError, KeyError, AttributeError):
+                self.__logger.error("Discarding corrupt spooled payload")
+                readings = None
+            if readings is not None:
+                current_envelope = json.dumps(current, sort_keys=True)
+                if data is not None and (current_envelope != envelope or
+                        len(data['service']) + len(readings) > maxReadings):
+                    yield data, len(data['service']), payloads, offset
+                    data = None
+                if data is None:
+                    data = current
+                    data['service'] = []
+                    envelope = current_envelope
+                    payloads = 0
+                data['service'].extend(readings)
+            payloads += 1
+            offset = payload_offset
+        if data is not None:
+            yield data, len(data['service']), payloads, offset
+        elif offset is not None:
+            self.__spool.commit(offset)
+
+    def __postRawJSONData(self, data):
+        """Insert the raw data string to the server, retrying failures as
+        the retry policy says
+        """
+        attempt = 0
+        while True:
+            result = self.__postOnce(data)
+            if not self.__failed(result) or \
+                    attempt >= self.__retry_policy.max_retries or \
+                    (self.__breaker is not None and self.__breaker.isOpen()):
+                return result
+            if self.__background_retries:
+                self.__scheduleRetry(data, attempt)
+                return (-1, 'RETRYING')
+            time.sleep(self.__retry_policy.delay(attempt))
+            attempt += 1
+
+    def __postOnce(self, data):
+        """Make a single insert attempt of the raw data string
         """
+        if self.__breaker is not None and not self.__breaker.allow():
+            self.__logger.debug("Circuit open, insert refused")
+            return (-1, 'FAIL')
         params = 'data=' + data
         headers = {"Content-type": "application/x-www-form-urlencoded",
                    "Accept": "text/plain"}
-        if self.__https:
-            conn = httplib.HTTPSConnection(self.__server,
-                                           timeout=self.__timeout)
+        try:
+            if self.__compress and len(params) >= self.__compress_min_size:
+                response = self.__postCompressed(params, headers)
+            else:
+                response = self.__getPool().request("POST", self.__url,
+                                                    params, headers)
+        except Exception:
+            self.__logger.exception("Error inserting data")
+            result = (-1, 'FAIL')
         else:
-            conn = httplib.HTTPConnection(self.__server,
-                                          timeout=self.__timeout)
-        conn.request("POST", self.__url, params, headers)
-        error = True
-        maxerror = 0
-        while error:
-            try:
-                response = conn.getresponse()
-                error = False
-            except:
-                print self.__logger.exception("Error inserting data")
-                maxerror = maxerror + 1
-                time.sleep(1)
-                if maxerror > 10:
-                    return (-1, 'FAIL')
-        logger_msg_wo_params = "Insert from %s with status %s and result %s"
-        logger_params = (self.__gateway, str(response.status),
-                         str(response.getheader('data')))
-        logger_message = logger_msg_wo_params % logger_params
-        self.__logger.debug(logger_message)
-        return response.status, response.getheader('data')
+            logger_msg_wo_params = "Insert from %s with status %s and result %s"
+            logger_params = (self.__gateway, str(response.status),
+                             str(response.getheader('data')))
+            logger_message = logger_msg_wo_params % logger_params
+            self.__logger.debug(logger_message)
+            result = (response.status, response.getheader('data'))
+        if self.__breaker is not None:
+            if self.__failed(result):
+                self.__breaker.recordFailure()
+            else:
+                self.__breaker.recordSuccess()
+        return result
+
+    def __postCompressed(self, params, headers):
+        """POST the gzip compressed params, falling back to an uncompressed
+        body for good if the server rejects compressed ones
+        """
+        start = time.clock()
+        compressor = zlib.compressobj(self.__compress_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        body = compressor.compress(params) + compressor.flush()
+        cpu = time.clock() - start
+        self.__logger.debug("Insert compressed from %d to %d bytes "
+                            "(ratio %.2f) in %.1f ms of CPU" %
+                            (len(params), len(body),
+                             float(len(params)) / len(body), cpu * 1000))
+        compressed_headers = dict(headers)
+        compressed_headers["Content-Encoding"] = "gzip"
+        pool = self.__getPool()
+        response = pool.request("POST", self.__url, body, compressed_headers)
+        if response.status not in (400, 415):
+            return response
+        response = pool.request("POST", self.__url, params, headers)
+        if response.status < 400:
+            self.__logger.warning("Server rejected a compressed insert, "
+                                  "compression disabled")
+            self.__compress = False
+        return response
+
+    def __pushRetry(self, data, attempt):
+        due = time.time() + self.__retry_policy.delay(attempt)
+        self.__retry_count += 1
+        heapq.heappush(self.__retries,
+                       (due, self.__retry_count, data, attempt + 1))
+
+    def __scheduleRetry(self, data, attempt):
+        with self.__retry_cond:
+            self.__pushRetry(data, attempt)
+            if self.__retry_thread is None:
+                self.__retry_thread = threading.Thread(
+                    target=self.__retryWorker, name='DexcellSender-retry')
+                self.__retry_thread.daemon = True
+                self.__retry_thread.start()
+            self.__retry_cond.notify()
+
+    def __retryWorker(self):
+        """Retry the scheduled inserts when they are due. On close the
+        pending retries are attempted once and spooled if they fail
+        """
+        while True:
+            with self.__retry_cond:
+                closing = self.__retry_thread is None
+                while not closing and (not self.__retries or
+                                       self.__retries[0][0] > time.time()):
+                    if self.__retries:
+                        self.__retry_cond.wait(self.__retries[0][0] -
+                                               time.time())
+                    else:
+                        self.__retry_cond.wait()
+                    closing = self.__retry_thread is None
+                if not self.__retries:
+                    return
+                due, count, data, attempt = heapq.heappop(self.__retries)
+            result = self.__postOnce(data)
+            if not self.__failed(result):
+                if self.__spool is not None and self.__spool.pending() > 0:
+                    self.__startReplay()
+                continue
+            if not closing and attempt < self.__retry_policy.max_retries and \
+                    (self.__breaker is None or not self.__breaker.isOpen()):
+                with self.__retry_cond:
+                    if self.__retry_thread is not None:
+                        self.__pushRetry(data, attempt)
+                        continue
+            self.__spoolFailed(data)
 
     def insertDexcellServiceMessage(self, serviceMessage,
                                     timezone='UTC', extraparams={}):
         '''Insert a single DexcellServiceMessage
         '''
-        reading = {
-            'nodeNetworkId': str(serviceMessage.node),
-            'serviceNetworkId': int(serviceMessage.service),
-            'value': float(serviceMessage.value),
-            'seqNum': int(serviceMessage.seqnum),
-            'timeStamp': time.strftime("%Y-%m-%dT%H:%M:%S.000 " + timezone,
-                                       serviceMessage.timestamp)
-        }
-        data = {
-            'gatewayId': self.__gateway,
-            'service': [reading]
-        }
-        for key in extraparams.keys():
-            data[key] = extraparams[key]
-        result = self.__insertRawJSONData(json.dumps(data))
-        return result
+        if self.__deadband is not None and \
+                not self.__deadband.accept(serviceMessage):
+            self.__logger.debug("Reading inside deadband not sent")
+            return (200, 'OK')
+        reading = self.__encoder.encodeReading(serviceMessage, timezone)
+        return self.__insertReadings([reading], extraparams)
 
     def insertDexcellServiceMessages(self, serviceMessageIterator,
-                                     timezone='UTC', extraparams={}):
+                                     timezone='UTC', extraparams={},
+                                     chunk_readings=None, chunk_bytes=None,
+                                     workers=1):
         """ Insert many DexcellServiceMessages at once
+
+        serviceMessageIterator may also be a DexcellServiceMessageBatch, which
+        is serialized straight from its columns.
+
+        When chunk_readings or chunk_bytes is given the iterator is consumed
+        lazily and cut into chunks of at most that many readings or encoded
+        bytes, which are uploaded by up to workers threads. In that case a
+        list of DexcellChunkResult is returned instead of a single status.
         """
+        if self.__deadband is not None:
+            serviceMessageIterator = self.__applyDeadband(
+                serviceMessageIterator)
+        if chunk_readings is None and chunk_bytes is None:
+            readings = self.__encoder.encodeReadings(serviceMessageIterator,
+                                                     timezone)
+            if not readings and self.__deadband is not None:
+                self.__logger.debug("Readings inside deadband not sent")
+                return (200, 'OK')
+            return self.__insertReadings(readings, extraparams)
+
+        def insertChunk(chunk):
+            index, messages, readings = chunk
+            return self.__insertReadings(readings, extraparams)
+
+        chunks = self.__chunkMessages(serviceMessageIterator, timezone,
+                                      chunk_readings, chunk_bytes)
+        results = []
+        for chunk, result, error in _imap_unordered(insertChunk, chunks,
+                                                    workers):
+            index, messages, readings = chunk
+            if error is not None:
+                self.__logger.error("Error inserting chunk %d: %s" %
+                                    (index, str(error)))
+                result = (-1, 'FAIL')
+                deferred = False
+            else:
+                deferred = self.__deferred(result)
+            failed = None
+            if result[0] != 200 and not deferred:
+                failed = messages
+            results.append(DexcellChunkResult(index, result[0], result[1],
+                                              len(messages), failed,
+                                              deferred))
+        results.sort(key=lambda chunkResult: chunkResult.index)
+        return results
+
+    def __applyDeadband(self, serviceMessageIterator):
+        if isinstance(serviceMessageIterator, DexcellServiceMessageBatch):
+            return self.__deadband.filterBatch(serviceMessageIterator)
+        return (serviceMessage for serviceMessage in serviceMessageIterator
+                if self.__deadband.accept(serviceMessage))
+
+    def __insertReadings(self, readings, extraparams):
+        """Insert a list of readings encoded by DexcellReadingEncoder
+        """
+        data = self.__encoder.encodePayload(self.__gateway, readings,
+                                            extraparams)
+        return self.__insertRawJSONData(data)
+
+    def __chunkBatch(self, batch, timezone, chunk_readings, chunk_bytes):
+        """Yield (index, slice, readings) chunks of a
+        DexcellServiceMessageBatch, encoded from its columns a slice at a
+        time
+        """
+        index = 0
+        start = 0
         readings = []
+        size = 0
+        for offset in xrange(0, len(batch), 1024):
+            encoded = self.__encoder.encodeReadings(
+                batch[offset:offset + 1024], timezone)
+            for position, reading in enumerate(encoded, offset):
+                reading_size = len(reading) + 2
+                if readings and chunk_bytes is not None and \
+                        size + reading_size > chunk_bytes:
+                    yield index, batch[start:position], readings
+                    index += 1
+                    start = position
+                    readings = []
+                    size = 0
+                readings.append(reading)
+                size += reading_size
+                if chunk_readings is not None and \
+                        len(readings) >= chunk_readings:
+                    yield index, batch[start:position + 1], readings
+                    index += 1
+                    start = position + 1
+                    readings = []
+                    size = 0
+        if readings:
+            yield index, batch[start:], readings
+
+    def __chunkMessages(self, serviceMessageIterator, timezone,
+                        chunk_readings, chunk_bytes):
+        """Yield (index, messages, readings) chunks bounded by reading count
+        and encoded size. The messages of a DexcellServiceMessageBatch are
+        slices of it
+        """
+        if isinstance(serviceMessageIterator, DexcellServiceMessageBatch):
+            for chunk in self.__chunkBatch(serviceMessageIterator, timezone,
+                                           chunk_readings, chunk_bytes):
+                yield chunk
+            return
+        index = 0
+        messages = []
+        readings = []
+        size = 0
         for serviceMessage in serviceMessageIterator:
-            reading = {
-                'nodeNetworkId': str(serviceMessage.node),
-                'serviceNetworkId': int(serviceMessage.service),
-                'value': float(serviceMessage.value),
-                'seqNum': int(serviceMessage.seqnum),
-                'timeStamp': time.strftime("%Y-%m-%dT%H:%M:%S.000 " + timezone,
-                                           serviceMessage.timestamp)
-            }
+            reading = self.__encoder.encodeReading(serviceMessage, timezone)
+            reading_size = len(reading) + 2
+            if readings and chunk_bytes is not None and \
+                    size + reading_size > chunk_bytes:
+                yield index, messages, readings
+                index += 1
+                messages = []
+                readings = []
+                size = 0
+            messages.append(serviceMessage)
             readings.append(reading)
-        data = {
-            'gatewayId': self.__gateway,
-            'service': readings
-        }
-        for key in extraparams.keys():
-            data[key] = extraparams[key]
-        result = self.__insertRawJSONData(json.dumps(data))
-        return result
+            size += reading_size
+            if chunk_readings is not None and len(readings) >= chunk_readings:
+                yield index, messages, readings
+                index += 1
+                messages = []
+                readings = []
+                size = 0
+        if readings:
+            yield index, messages, readings
+
+    __STOP = object()
+    __FLUSH = object()
+
+    def enqueue(self, serviceMessage, timezone='UTC'):
+        """Queue a DexcellServiceMessage and return immediately
+
+        A worker thread coalesces the queued readings into a single insert
+        once batch_max_readings, batch_max_bytes or batch_max_age is reached.
+        """
+        if self.__deadband is not None and \
+                not self.__deadband.accept(serviceMessage):
+            return
+        with self.__worker_lock:
+            if self.__worker is None:
+                self.__queue = Queue.Queue()
+                self.__worker = threading.Thread(target=self.__queueWorker,
+                                                 name='DexcellSender-queue')
+                self.__worker.daemon = True
+                self.__worker.start()
+            self.__queue.put((serviceMessage, timezone, time.time()))
+
+    def flush(self):
+        """Block until every reading queued so far has been sent
+        """
+        with self.__worker_lock:
+            if self.__worker is None:
+                return
+            done = threading.Event()
+            self.__queue.put((self.__FLUSH, done))
+        done.wait()
+
+    def __sendBatch(self, readings):
+        try:
+            result = self.__insertReadings(readings, {})
+        except Exception:
+            self.__logger.exception("Error inserting queued readings")
+            return
+        if result[0] != 200:
+            self.__logger.error("Queued insert of %d readings failed: %s" %
+                                (len(readings), str(result)))
+
+    def __queueWorker(self):
+        readings = []
+        size = 0
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    item = self.__queue.get()
+                else:
+                    timeout = max(deadline - time.time(), 0)
+                    item = self.__queue.get(True, timeout)
+            except Queue.Empty:
+                item = None
+            if item is None or item is self.__STOP or \
+                    item[0] is self.__FLUSH:
+                if readings:
+                    self.__sendBatch(readings)
+                readings = []
+                size = 0
+                deadline = None
+                if item is self.__STOP:
+                    return
+                if item is not None:
+                    item[1].set()
+                continue
+            serviceMessage, timezone, queued = item
+            try:
+                reading = self.__encoder.encodeReading(serviceMessage,
+                                                       timezone)
+            except Exception:
+                self.__logger.exception("Discarding invalid queued reading")
+                continue
+            reading_size = len(reading) + 2
+            if readings and size + reading_size > self.__batch_max_bytes:
+                self.__sendBatch(readings)
+                readings = []
+                size = 0
+                deadline = None
+            readings.append(reading)
+            size += reading_size
+            if deadline is None:
+                deadline = queued + self.__batch_max_age
+            if len(readings) >= self.__batch_max_readings or \
+                    size >= self.__batch_max_bytes:
+                self.__sendBatch(readings)
+                readings = []
+                size = 0
+                deadline = None
+
+
+class DexcellFuture(object):
+    """
+    The pending result of an insert made through DexcellAsyncSender
+    """
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__error = None
+
+    def done(self):
+        """Return True once the insert has completed
+        """
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the insert and return its (status, data) tuple, raising
+        the exception of the insert if it failed
+        """
+        if not self.__done.wait(timeout):
+            raise Exception("Timeout waiting for the insert result")
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+    def addDoneCallback(self, callback):
+        """Call callback(future) once the insert has completed
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def _setResult(self, result=None, error=None):
+        with self.__lock:
+            self.__result = result
+            self.__error = error
+            self.__done.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class DexcellAsyncSender(object):
+    """
+    A non-blocking DexcellSender for gateways that forward many upstreams.
+
+    insertDexcellServiceMessage(s) return a DexcellFuture right away while up
+    to concurrency POSTs run in parallel over persistent connections. At
+    most max_pending inserts may be queued or in flight; past that limit
+    the insert calls block, or raise with block=False, until one of them
+    completes. The remaining keyword arguments are passed to DexcellSender.
+    """
+
+    def __init__(self, gateway=DexcellSender.DEFAULT_GATEWAY, concurrency=8,
+                 max_pending=None, **senderOptions):
+        senderOptions.setdefault('pool_size', concurrency)
+        self.__sender = DexcellSender(gateway=gateway, **senderOptions)
+        if max_pending is None:
+            max_pending = 2 * concurrency
+        self.__pending = threading.BoundedSemaphore(max_pending)
+        self.__tasks = Queue.Queue()
+        self.__workers = []
+        for i in range(concurrency):
+            worker = threading.Thread(target=self.__work,
+                                      name='DexcellAsyncSender-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            future, insert, args = task
+            try:
+                result = insert(*args)
+            except Exception as e:
+                future._setResult(error=e)
+            else:
+                future._setResult(result)
+            finally:
+                self.__pending.release()
+
+    def __submit(self, insert, args, block):
+        if not self.__workers:
+            raise Exception("DexcellAsyncSender is closed")
+        if not self.__pending.acquire(block):
+            raise Exception("Too many inserts in flight")
+        future = DexcellFuture()
+        self.__tasks.put((future, insert, args))
+        return future
+
+    def changeGateway(self, gateway):
+        """Change the gateway mac that will be sent
+        """
+        self.__sender.changeGateway(gateway)
+
+    def insertDexcellServiceMessage(self, serviceMessage, timezone='UTC',
+                                    extraparams={}, block=True):
+        """Insert a single DexcellServiceMessage, returning a DexcellFuture
+        """
+        return self.__submit(self.__sender.insertDexcellServiceMessage,
+                             (serviceMessage, timezone, extraparams), block)
+
+    def insertDexcellServiceMessages(self, serviceMessageIterator,
+                                     timezone='UTC', extraparams={},
+                                     block=True):
+        """Insert many DexcellServiceMessages at once, returning a
+        DexcellFuture
+        """
+        if not isinstance(serviceMessageIterator, DexcellServiceMessageBatch):
+            serviceMessageIterator = list(serviceMessageIterator)
+        return self.__submit(self.__sender.insertDexcellServiceMessages,
+                             (serviceMessageIterator, timezone, extraparams),
+                             block)
+
+    def close(self):
+        """Wait for the pending inserts and close the connections
+        """
+        workers = self.__workers
+        self.__workers = []
+        for worker in workers:
+            self.__tasks.put(None)
+        for worker in workers:
+            worker.join()
+        self.__sender.close()
+
+
+_ISO_DATETIME = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}")
+_SIXTY = dict(('%02d' % i, i) for i in range(60))
+# "YYYY-MM-DD HH" prefix of decoded timestamps -> (datetime, epoch)
+_TIMESTAMP_HOURS = {}
+_TIMESTAMP_HOURS_MAX = 100000
+
+
+def _decode_timestamp(value, format="%Y-%m-%d %H:%M:%S", epoch=False):
+    """Return datetime.strptime(value, format), or its seconds since the
+    epoch taken as UTC when epoch is set. format is one of the api date
+    formats followed by %H:%M:%S; the date and hour of every value are
+    parsed once and the minutes and seconds are added to the cached hour.
+    """
+    hour = _TIMESTAMP_HOURS.get(value[:13])
+    if hour is not None and len(value) == 19 and value[13] == ':' and value[16] == ':':
+        try:
+            minute = _SIXTY[value[14:16]]
+            second = _SIXTY[value[17:19]]
+        except KeyError:
+            pass
+        else:
+            if epoch:
+                return hour[1] + minute * 60 + second
+            return hour[0].replace(minute=minute, second=second)
+    dt = datetime.strptime(value, format)
+    if len(value) == 19 and value[13] == ':' and value[16] == ':':
+        if len(_TIMESTAMP_HOURS) >= _TIMESTAMP_HOURS_MAX:
+            _TIMESTAMP_HOURS.clear()
+        base = dt.replace(minute=0, second=0)
+        _TIMESTAMP_HOURS[value[:13]] = (base, calendar.timegm(base.timetuple()))
+    if epoch:
+        return calendar.timegm(dt.timetuple())
+    return dt
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStream(object):
+    """Incremental reader of the values of a JSON document read in chunks
+    from a file-like object, keeping only the unparsed part in memory.
+    """
+    def __init__(self, stream, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ read the next chunk, return False at the end of the stream """
+        if self.eof:
+            return False
+        data = self.stream.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ return the next non whitespace character, '' at the end """
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """ consume and return the next character, one of chars """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expecting one of %r: %r' % (chars, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ consume and return the next complete JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # incomplete value, unless the stream is over
+                if not self.fill():
+                    raise
+                continue
+            # a number cut at the end of the chunk goes on in the next one
+            if (end < len(self.buffer) and self.buffer[end] not in '0123456789.eE+-') or not self.fill():
+                self.pos = end
+                return value
+
+
+def _iter_json_array(stream, key=None, chunk_size=65536):
+    """Yield the items of the JSON array read from stream, or of the array
+    member key when the document is an object, as they are parsed.
+    """
+    reader = _JSONStream(stream, chunk_size)
+    if reader.peek() == '{':
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name == key and reader.peek() == '[':
+                break
+            reader.value()
+            if reader.expect(',}') == '}':
+                return
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+_REST_POOLS = {}
+_REST_POOLS_LOCK = threading.Lock()
+_REST_POOL_SIZE = 8
+_REST_TIMEOUT = 600.0
+_REST_MAX_REDIRECTS = 5
+
+
+def _rest_pool(https, host, port, tunnel=None):
+    """Return the connection pool shared by every REST client of a host"""
+    key = (https, host, port, tunnel)
+    with _REST_POOLS_LOCK:
+        pool = _REST_POOLS.get(key)
+        if pool is None:
+            pool = _REST_POOLS[key] = DexcellConnectionPool(
+                host, https, _REST_TIMEOUT, _REST_POOL_SIZE, port=port,
+                tunnel=tunnel)
+        return pool
+
+
+class _DexcellRestResponse(object):
+    """File-like body of a pooled REST response, gunzipped as it is read.
+    Closing it gives the connection back to the pool.
+    """
+    def __init__(self, url, pool, response):
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.pool = pool
+        self.response = response
+        self.decompressor = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            if size < 0:
+                return self.response.read()
+            return self.response.read(size)
+        if size < 0:
+            return self.decompressor.decompress(self.response.read()) + self.decompressor.flush()
+        while True:
+            data = self.response.read(size)
+            if not data:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(data)
+            if data:
+                return data
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self.response)
+            self.pool = None
+
+
+_URLLIB2_HANDLERS = (urllib2.ProxyHandler, urllib2.UnknownHandler, urllib2.HTTPHandler,
+                     urllib2.HTTPDefaultErrorHandler, urllib2.HTTPRedirectHandler,
+                     urllib2.FTPHandler, urllib2.FileHandler, urllib2.HTTPErrorProcessor,
+                     getattr(urllib2, 'HTTPSHandler', urllib2.HTTPHandler))
+
+
+def _rest_opener():
+    """Return the opener installed with urllib2.install_opener, or None if
+    there is none or it is the default one urllib2.urlopen installs
+    """
+    opener = urllib2._opener
+    if opener is None:
+        return None
+    if opener.addheaders != urllib2.OpenerDirector().addheaders:
+        return opener
+    for handler in opener.handlers:
+        if handler.__class__ not in _URLLIB2_HANDLERS or \
+                getattr(handler, '_context', None) is not None:
+            return opener
+        if handler.__class__ is urllib2.ProxyHandler and \
+                handler.proxies != urllib.getproxies():
+            return opener
+    return None
+
+
+def _rest_proxy(parts):
+    """Return the (host, port, headers) of the environment proxy the url
+    split in parts goes through, or None
+    """
+    proxy = urllib.getproxies().get(parts.scheme)
+    if proxy is None or urllib.proxy_bypass(parts.netloc):
+        return None
+    scheme, user, password, hostport = urllib2._parse_proxy(proxy)
+    host, port = urllib.splitport(hostport)
+    headers = ()
+    if user is not None:
+        credentials = '%s:%s' % (urllib.unquote(user), urllib.unquote(password or ''))
+        headers = (('Proxy-Authorization', 'Basic ' + base64.b64encode(credentials)),)
+    return host, int(port) if port else None, headers
+
+
+def _rest_open(url, body=None, headers={}):
+    """Request url through the shared connection pool of its host, as a
+    POST of body when given, following redirects. Return the response as
+    a _DexcellRestResponse, raise urllib2.HTTPError on error statuses and
+    urllib2.URLError when the server can not be reached, as urlopen does.
+    Requests go through the proxies of the environment, https ones in a
+    tunnel, and through urllib2 when an opener was installed.
+    """
+    opener = _rest_opener()
+    if opener is not None:
+        return opener.open(urllib2.Request(url, body, headers), timeout=_REST_TIMEOUT)
+    headers = dict(headers)
+    headers['Accept-Encoding'] = 'gzip'
+    for i in range(_REST_MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        https = parts.scheme == 'https'
+        proxy = _rest_proxy(parts)
+        request_headers = headers
+        if proxy is None:
+            pool = _rest_pool(https, parts.hostname, parts.port)
+        elif https:
+            pool = _rest_pool(True, proxy[0], proxy[1], (parts.hostname, parts.port, proxy[2]))
+        else:
+            pool = _rest_pool(False, proxy[0], proxy[1])
+            path = urlparse.urlunsplit(parts[:4] + ('',))
+            request_headers = dict(headers)
+            request_headers.update(proxy[2])
+        try:
+            response = pool.open('GET' if body is None else 'POST', path, body, request_headers)
+        except (socket.error, httplib.HTTPException) as e:
+            raise urllib2.URLError(e)
+        response = _DexcellRestResponse(url, pool, response)
+        if 200 <= response.code < 300:
+            return response
+        try:
+            data = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            raise urllib2.URLError(e)
+        finally:
+            response.close()
+        location = response.headers.getheader('location')
+        if response.code in (301, 302, 303, 307) and location:
+            url = urlparse.urljoin(url, location)
+            if response.code != 307:
+                body = None
+                headers.pop('Content-Type', None)
+            continue
+        raise urllib2.HTTPError(url, response.code, response.msg, response.headers, StringIO(data))
+    raise urllib2.HTTPError(url, response.code, 'too many redirects', response.headers, StringIO(data))
 
 
 class DexcellRestApiError(Exception):
@@ -380,20 +2539,21 @@ class DexcellRestApiAuth(object):
 
     def _datetime_parser(self, dct):
         DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
-        strp = datetime.strptime
         for k, v in dct.items():
-            if isinstance(v, basestring) and re.search("\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}", v):
+            if isinstance(v, basestring) and len(v) >= 19 and _ISO_DATETIME.search(v):
                 try:
-                    dct[k] = strp(v, DATE_FORMAT)
+                    dct[k] = _decode_timestamp(v, DATE_FORMAT)
                 except ValueError:
                     pass
         return dct
 
     def _call_rest(self, url):
         url = self.endpoint + url
-        req = urllib2.Request(url)
-        response = urllib2.urlopen(req)
-        data = response.read()
+        response = _rest_open(url)
+        try:
+            data = response.read()
+        finally:
+            response.close()
         self.logger.info(data)
         return data
 
@@ -406,24 +2566,505 @@ class DexcellRestApiAuth(object):
     def set_key_value(self, key, value):
         "Set this key with this value in the key-value data store"
         url = self.endpoint + "/things/set/" + key
-        req = urllib2.Request(url, json.dumps(value, default=self._json_date_handler),
-                              headers={'x-dexcell-secret': self.secret})
         self.logger.info('storing key: %s with secret: %s' % (key, self.secret))
-        response = urllib2.urlopen(req)
-        data = response.read()
+        response = _rest_open(url, json.dumps(value, default=self._json_date_handler),
+                              headers={'x-dexcell-secret': self.secret})
+        try:
+            data = response.read()
+        finally:
+            response.close()
         return data
 
     def get_key(self, key):
         "Get this key from the key-value data store"
         url = "%s/things/get/%s" % (self.endpoint, key)
-        req = urllib2.Request(url, headers={'x-dexcell-secret': self.secret})
-        response = urllib2.urlopen(req)
-        data = response.read()
+        response = _rest_open(url, headers={'x-dexcell-secret': self.secret})
+        try:
+            data = response.read()
+        finally:
+            response.close()
         data = json.loads(data, object_hook=self._datetime_parser)
         result = json.loads(data['result'], object_hook=self._datetime_parser)
         return result
 
 
+class DexcellRestCache(object):
+    """
+    Base class of the DexcellRestApi response caches.
+
+    Subclasses implement _get, _set and _invalidate; this class keeps the
+    hit, miss and eviction statistics.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired
+        """
+        value = self._get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        """Cache value for ttl seconds
+        """
+        self._set(key, value, time.time() + ttl)
+
+    def invalidate(self, prefix=''):
+        """Drop every entry whose key starts with prefix
+        """
+        self._invalidate(prefix)
+
+    def stats(self):
+        """Return a dict with the hit, miss and eviction counts
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class DexcellMemoryCache(DexcellRestCache):
+    """
+    An in-memory LRU cache of at most max_entries responses
+    """
+
+    def __init__(self, max_entries=1024):
+        DexcellRestCache.__init__(self)
+        self.max_entries = max_entries
+        self.__entries = collections.OrderedDict()
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                return None
+            self.__entries[key] = entry
+            return entry[1]
+
+    def _set(self, key, value, expires):
+        with self.lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (expires, value)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def _invalidate(self, prefix):
+        with self.lock:
+            for key in self.__entries.keys():
+                if key.startswith(prefix):
+                    del self.__entries[key]
+
+
+class DexcellDiskCache(DexcellRestCache):
+    """
+    An on-disk LRU cache of at most max_entries responses, one JSON file per
+    entry inside directory, that survives restarts and can be shared
+    between processes. When full, the least recently used tenth of the
+    entries is evicted at once
+    """
+
+    def __init__(self, directory, max_entries=10000):
+        DexcellRestCache.__init__(self)
+        self.directory = directory
+        self.max_entries = max_entries
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # entries stored since the directory was last listed, as other
+        # processes may be writing to it too
+        self.__count = len(self.__entries())
+
+    def __path(self, key):
+        name = hashlib.sha1(key).hexdigest() + '.json'
+        return os.path.join(self.directory, name)
+
+    def __entries(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.json')]
+
+    def _get(self, key):
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry['key'] != key:
+            return None
+        if entry['expires'] <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry['value']
+
+    def _set(self, key, value, expires):
+        path = self.__path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            json.dump({'key': key, 'expires': expires, 'value': value}, f)
+        exists = os.path.exists(path)
+        if os.name == 'nt' and exists:
+            os.remove(path)
+        os.rename(tmp_path, path)
+        with self.lock:
+            if not exists:
+                self.__count += 1
+            if self.__count <= self.max_entries:
+                return
+            self.__count = 0
+        self.__evict()
+
+    def __evict(self):
+        entries = self.__entries()
+        keep = len(entries)
+        if keep > self.max_entries:
+            keep = self.max_entries - self.max_entries // 10
+            mtimes = {}
+            for entry in entries:
+                try:
+                    mtimes[entry] = os.stat(entry).st_mtime
+                except OSError:
+                    continue
+            entries = sorted(mtimes, key=mtimes.get)
+            for entry in entries[:len(entries) - keep]:
+                try:
+                    os.remove(entry)
+                except OSError:
+                    continue
+                with self.lock:
+                    self.evictions += 1
+        with self.lock:
+            self.__count += min(keep, len(entries))
+
+    def _invalidate(self, prefix):
+        for path in self.__entries():
+            try:
+                with open(path, 'rb') as f:
+                    key = json.load(f)['key']
+                if key.startswith(prefix):
+                    os.remove(path)
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+
+
+class DexcellReadingsStore(object):
+    """
+    A SQLite store of the readings fetched with DexcellRestApi.get_readings_new,
+    recording for every (dev_id, param, frequency, operation) series which
+    time ranges were already fetched so only the gaps are requested again.
+    Ranges ending less than lag seconds ago are stored but not marked as
+    covered, as their last readings may still change.
+    """
+
+    def __init__(self, path, lag=86400):
+        self.path = path
+        self.lag = lag
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS readings ('
+                            'series TEXT, ts INTEGER, tsutc INTEGER, data TEXT, '
+                            'PRIMARY KEY (series, tsutc))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS readings_ts ON readings (series, ts)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS coverage ('
+                            'series TEXT, start INTEGER, end INTEGER)')
+            self.db.commit()
+
+    def series(self, dev_id, param, frequency, operation):
+        """ return the key of the series of readings """
+        return '%s/%s/%s/%s' % (dev_id, param, frequency, operation)
+
+    def _epoch(self, dt):
+        return calendar.timegm(dt.timetuple())
+
+    def gaps(self, series, start, end):
+        """ return list of (start, end) datetimes of the interval start - end
+            not covered yet
+        """
+        start = self._epoch(start)
+        end = self._epoch(end)
+        with self.lock:
+            covered = self.db.execute('SELECT start, end FROM coverage '
+                                      'WHERE series = ? AND end >= ? AND start <= ? '
+                                      'ORDER BY start', (series, start, end)).fetchall()
+        gaps = []
+        for covered_start, covered_end in covered:
+            if covered_start > start:
+                gaps.append((start, covered_start))
+            start = max(start, covered_end)
+        if start < end or start == end and not covered:
+            gaps.append((start, end))
+        return [(datetime.utcfromtimestamp(gap_start), datetime.utcfromtimestamp(gap_end))
+                for gap_start, gap_end in gaps]
+
+    def add(self, series, start, end, readings):
+        """ store readings, with epoch timestamps, fetched for the interval
+            start - end and mark the part of it older than lag as covered
+        """
+        rows = [(series, reading['ts'], reading['tsutc'], json.dumps(reading))
+                for reading in readings if 'ts' in reading and 'tsutc' in reading]
+        start = self._epoch(start)
+        end = min(self._epoch(end), self._epoch(datetime.now()) - self.lag)
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?)', rows)
+            if start < end:
+                merged = self.db.execute('SELECT MIN(start), MAX(end) FROM coverage '
+                                         'WHERE series = ? AND end >= ? AND start <= ?',
+                                         (series, start, end)).fetchone()
+                if merged[0] is not None:
+                    start = min(start, merged[0])
+                    end = max(end, merged[1])
+                self.db.execute('DELETE FROM coverage WHERE series = ? AND end >= ? AND start <= ?',
+                                (series, start, end))
+                self.db.execute('INSERT INTO coverage VALUES (?, ?, ?)', (series, start, end))
+            self.db.commit()
+
+    def readings(self, series, start, end):
+        """ return list of the stored readings, with epoch timestamps, of the
+            interval start - end
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM readings '
+                                   'WHERE series = ? AND ts >= ? AND ts <= ? ORDER BY tsutc',
+                                   (series, self._epoch(start), self._epoch(end))).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def clear(self, series=None):
+        """ drop the readings and coverage of series, or of every series """
+        with self.lock:
+            if series is None:
+                self.db.execute('DELETE FROM readings')
+                self.db.execute('DELETE FROM coverage')
+            else:
+                self.db.execute('DELETE FROM readings WHERE series = ?', (series,))
+                self.db.execute('DELETE FROM coverage WHERE series = ?', (series,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class DexcellDeploymentTopology(object):
+    """
+    An in-memory snapshot of the locations, devices, parameters and supplies
+    of a deployment and how they relate, indexed so lookups never call the
+    api. Build it with DexcellRestApi.get_deployment_topology, bring it up
+    to date with refresh and keep it between runs with save and load.
+    """
+
+    def __init__(self, dep_id):
+        self.dep_id = dep_id
+        self.deployment = None
+        self.loaded = None
+        self.locations = {}
+        self.devices = {}
+        self.parameters = {}
+        self.supplies = {}
+        # relations as lists of ids
+        self.location_devices = {}
+        self.location_supplies = {}
+        self.parameter_devices = {}
+        # parameters of every device as returned by get_device_parameters
+        self.device_parameters = {}
+        self._index()
+
+    def _index(self):
+        self.devices_by_networkid = {}
+        for device in self.devices.itervalues():
+            if device.get('networkid') is not None:
+                self.devices_by_networkid[device['networkid']] = device
+        self.supplies_by_pod = {}
+        for supply in self.supplies.itervalues():
+            if supply.get('pod') is not None:
+                self.supplies_by_pod[supply['pod']] = supply
+        self.device_locations = {}
+        for loc_id, dev_ids in self.location_devices.iteritems():
+            for dev_id in dev_ids:
+                self.device_locations[dev_id] = loc_id
+        self.supply_locations = {}
+        for loc_id, sup_ids in self.location_supplies.iteritems():
+            for sup_id in sup_ids:
+                self.supply_locations[sup_id] = loc_id
+
+    def location(self, loc_id):
+        return self.locations.get(loc_id)
+
+    def device(self, dev_id):
+        return self.devices.get(dev_id)
+
+    def device_by_networkid(self, networkid):
+        return self.devices_by_networkid.get(networkid)
+
+    def parameter(self, param_nid):
+        return self.parameters.get(param_nid)
+
+    def supply(self, sup_id):
+        return self.supplies.get(sup_id)
+
+    def supply_by_pod(self, pod):
+        return self.supplies_by_pod.get(pod)
+
+    def location_of_device(self, dev_id):
+        return self.locations.get(self.device_locations.get(dev_id))
+
+    def location_of_supply(self, sup_id):
+        return self.locations.get(self.supply_locations.get(sup_id))
+
+    def devices_of_location(self, loc_id):
+        return [self.devices[dev_id] for dev_id in self.location_devices.get(loc_id, [])
+                if dev_id in self.devices]
+
+    def supplies_of_location(self, loc_id):
+        return [self.supplies[sup_id] for sup_id in self.location_supplies.get(loc_id, [])
+                if sup_id in self.supplies]
+
+    def devices_of_parameter(self, param_nid):
+        return [self.devices[dev_id] for dev_id in self.parameter_devices.get(param_nid, [])
+                if dev_id in self.devices]
+
+    def parameters_of_device(self, dev_id):
+        return self.device_parameters.get(dev_id, [])
+
+    def _fetch(self, api, tasks, workers):
+        """ return dict of (kind, key) -> response for every task """
+        calls = {
+            'deployment': lambda key: api.get_deployment(self.dep_id),
+            'locations': lambda key: api.get_deployment_locations(self.dep_id),
+            'devices': lambda key: api.get_deployment_devices(self.dep_id),
+            'parameters': lambda key: api.get_deployment_parameters(self.dep_id),
+            'supplies': lambda key: api.get_deployment_supplies(self.dep_id),
+            'location_devices': api.get_location_devices,
+            'location_supplies': api.get_location_supplies,
+            'device_parameters': api.get_device_parameters,
+            'parameter_devices': lambda key: api.get_deployment_parameter_devices(self.dep_id, key),
+        }
+        responses = {}
+        for task, response, error in _imap_unordered(lambda task: calls[task[0]](task[1]), tasks, workers):
+            if error is not None:
+                raise error
+            responses[task] = response
+        return responses
+
+    def refresh(self, api, workers=8):
+        """ reload the snapshot with up to workers concurrent calls to api,
+            requesting the relations only of the locations, devices and
+            parameters new or changed since the last load. returns self.
+        """
+        responses = self._fetch(api, [('deployment', None), ('locations', None), ('devices', None),
+                                      ('parameters', None), ('supplies', None)], workers)
+        locations = dict((location['id'], location) for location in responses[('locations', None)])
+        devices = dict((device['id'], device) for device in responses[('devices', None)])
+        parameters = dict((parameter['id'], parameter) for parameter in responses[('parameters', None)])
+        supplies = dict((supply['id'], supply) for supply in responses[('supplies', None)])
+        deployment = responses[('deployment', None)]
+        devices_changed = set(devices) != set(self.devices)
+        supplies_changed = set(supplies) != set(self.supplies)
+
+        tasks = []
+        for loc_id, location in locations.iteritems():
+            changed = self.locations.get(loc_id) != location
+            if changed or devices_changed or loc_id not in self.location_devices:
+                tasks.append(('location_devices', loc_id))
+            if changed or supplies_changed or loc_id not in self.location_supplies:
+                tasks.append(('location_supplies', loc_id))
+        for dev_id, device in devices.iteritems():
+            if self.devices.get(dev_id) != device or dev_id not in self.device_parameters:
+                tasks.append(('device_parameters', dev_id))
+        for param_nid, parameter in parameters.iteritems():
+            if self.parameters.get(param_nid) != parameter or devices_changed or \
+                    param_nid not in self.parameter_devices:
+                tasks.append(('parameter_devices', param_nid))
+        responses = self._fetch(api, tasks, workers)
+
+        relations = {
+            'location_devices': (self.location_devices, locations),
+            'location_supplies': (self.location_supplies, locations),
+            'device_parameters': (self.device_parameters, devices),
+            'parameter_devices': (self.parameter_devices, parameters),
+        }
+        for relation, keys in relations.itervalues():
+            for key in relation.keys():
+                if key not in keys:
+                    del relation[key]
+        for (kind, key), response in responses.iteritems():
+            if kind == 'device_parameters':
+                self.device_parameters[key] = response
+            else:
+                relations[kind][0][key] = [item['id'] for item in response]
+        self.deployment = deployment
+        self.locations = locations
+        self.devices = devices
+        self.parameters = parameters
+        self.supplies = supplies
+        self.loaded = time.time()
+        self._index()
+        return self
+
+    def save(self, path):
+        """ write the snapshot to path as JSON """
+        data = {
+            'dep_id': self.dep_id,
+            'deployment': self.deployment,
+            'loaded': self.loaded,
+            'locations': self.locations.items(),
+            'devices': self.devices.items(),
+            'parameters': self.parameters.items(),
+            'supplies': self.supplies.items(),
+            'location_devices': self.location_devices.items(),
+            'location_supplies': self.location_supplies.items(),
+            'parameter_devices': self.parameter_devices.items(),
+            'device_parameters': self.device_parameters.items(),
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(data, f)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        """ replace the snapshot with the one saved in path. returns self """
+        with open(path, 'rb') as f:
+            data = json.load(f)
+        self.dep_id = data['dep_id']
+        self.deployment = data['deployment']
+        self.loaded = data['loaded']
+        for name in ('locations', 'devices', 'parameters', 'supplies', 'location_devices',
+                     'location_supplies', 'parameter_devices', 'device_parameters'):
+            setattr(self, name, dict((key, value) for key, value in data[name]))
+        self._index()
+        return self
+
+
+class _DexcellFlight(object):
+    """A REST call in progress that other threads can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
 class DexcellRestApi(object):
 
     """
@@ -431,9 +3072,54 @@ class DexcellRestApi(object):
         from deployment calls, location calls and devide calls.
     """
 
-    def __init__(self, endpoint, token, logger_name="dexcell_rest_api"):
+    # seconds to cache the responses of the metadata endpoints, readings,
+    # costs, notices, comments, sessions and things are never cached
+    DEFAULT_CACHE_TTLS = [
+        (r'^/deployments/\d+\.json$', 3600),
+        (r'^/deployments/\d+/(locations|devices|parameters|supplies)\.json$',
+         3600),
+        (r'^/deployments/\d+/parameters/[^/]+/devices\.json$', 3600),
+        (r'^/locations/\d+\.json$', 3600),
+        (r'^/locations/\d+/(parameters|supplies|devices)\.json$', 3600),
+        (r'^/locations/\d+/parameters/\d+/devices\.json$', 3600),
+        (r'^/devices/\d+\.json$', 3600),
+        (r'^/devices/\d+/parameters\.json$', 3600),
+    ]
+
+    # seconds per point of the fixed length readings frequencies
+    FREQUENCY_SECONDS = {
+        'MINUTE': 60,
+        'FIVE_MINUTES': 300,
+        'TEN_MINUTES': 600,
+        'QUARTER_HOUR': 900,
+        'FIFTEEN_MINUTES': 900,
+        'HALF_HOUR': 1800,
+        'HOUR': 3600,
+        'DAY': 86400,
+        'WEEK': 604800,
+    }
+    # points per request when get_readings_new splits long intervals
+    READINGS_WINDOW_POINTS = 10000
+    READINGS_WORKERS = 4
+    # cost periods that ended longer than this ago are cached as final
+    CLOSED_PERIOD_LAG = 86400
+    CLOSED_PERIOD_TTL = 90 * 86400
+
+    def __init__(self, endpoint, token, logger_name="dexcell_rest_api",
+                 cache=None, cache_ttls=None, store=None):
         self.endpoint = endpoint
         self.token = token
+        self.cache = cache
+        self.store = store
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        # closed cost periods when no cache is given
+        self.period_cache = DexcellMemoryCache(max_entries=16384)
+        if cache_ttls is None:
+            cache_ttls = self.DEFAULT_CACHE_TTLS
+        self.cache_ttls = [(re.compile(pattern), ttl)
+                           for pattern, ttl in cache_ttls]
+        self.cache_namespace = hashlib.sha1(endpoint + ' ' + token).hexdigest()[:16]
         self.logger = logging.getLogger(logger_name)
         if len(self.logger.handlers) == 0:
             self.logger.setLevel(logging.INFO)
@@ -448,9 +3134,9 @@ class DexcellRestApi(object):
     def _datetime_parser(self, dct):
         DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
         for k, v in dct.items():
-            if isinstance(v, basestring) and re.search("\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}", v):
+            if isinstance(v, basestring) and len(v) >= 19 and _ISO_DATETIME.search(v):
                 try:
-                    dct[k] = datetime.strptime(v, DATE_FORMAT)
+                    dct[k] = _decode_timestamp(v, DATE_FORMAT)
                 except:
                     pass
         return dct
@@ -459,20 +3145,95 @@ class DexcellRestApi(object):
         """ convert datetime into default date string format used in dexcell api calls """
         return dt.strftime("%Y%m%d%H%M%S")
 
+    def _cache_ttl(self, url):
+        """ return the seconds the response of url may be cached, if any """
+        path = url.split('?', 1)[0]
+        for pattern, ttl in self.cache_ttls:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def invalidate_cache(self, url_prefix=''):
+        """ drop the cached responses whose url starts with url_prefix """
+        if self.cache is not None:
+            self.cache.invalidate(self.cache_namespace + ' ' + url_prefix)
+
+    def cache_stats(self):
+        """ return dict with the hits, misses and evictions of the cache """
+        if self.cache is None:
+            return {'hits': 0, 'misses': 0, 'evictions': 0}
+        return self.cache.stats()
+
     def _call_rest(self, url, payload=None, parse_response=True):
+        ttl = None
+        if self.cache is not None and payload is None:
+            ttl = self._cache_ttl(url)
+        if ttl is None:
+            return self._single_flight((url, payload, parse_response),
+                                       lambda: self._fetch_rest(url, payload, parse_response))
+        return self._call_cached(self.cache, url, ttl, parse_response)
+
+    def _call_cached(self, cache, url, ttl, parse_response=True):
+        """ _call_rest keeping the response of url in cache for ttl seconds """
+        key = self.cache_namespace + ' ' + url
+        data = cache.get(key)
+        if data is None:
+            def fetch():
+                data = self._fetch_rest(url, parse_response=False)
+                cache.set(key, data, ttl)
+                return data
+            data = self._single_flight((url, None, False), fetch)
+        if parse_response:
+            return json.loads(data)
+        return data
+
+    def _single_flight(self, key, fetch):
+        """ return fetch(), making a single call for all the threads asking
+            for the same key at the same time. every thread gets its own
+            copy of the result, or the exception raised by the call.
+        """
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _DexcellFlight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+        try:
+            flight.result = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+        if flight.waiters:
+            return copy.deepcopy(flight.result)
+        return flight.result
+
+    def _fetch_rest(self, url, payload=None, parse_response=True):
+        response = self._open_rest(url, payload)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        if parse_response:
+            return json.loads(data)
+        else:
+            return data
+
+    def _open_rest(self, url, payload=None):
+        """ return the unread response of url """
         url = self.endpoint + url
         self.logger.info('url:%s token:%s' % (url, self.token))
-        if payload is None:
-            req = urllib2.Request(url, headers={'x-dexcell-token': self.token})
-        else:
-            req = urllib2.Request(url, payload, headers={'x-dexcell-token': self.token})
         try:
-            response = urllib2.urlopen(req, timeout=600.0)
-            data = response.read()
-            if parse_response:
-                return json.loads(data)
-            else:
-                return data
+            return _rest_open(url, payload, headers={'x-dexcell-token': self.token})
         except urllib2.HTTPError as httperror:
 
             info = json.loads(httperror.read())
@@ -539,6 +3300,13 @@ class DexcellRestApi(object):
         device_list = self._call_rest(url)
         return device_list
 
+    def get_deployment_topology(self, dep_id, workers=8):
+        """ return a DexcellDeploymentTopology with the locations, devices,
+            parameters and supplies of deployment dep_id, loaded with up to
+            workers concurrent calls
+        """
+        return DexcellDeploymentTopology(dep_id).refresh(self, workers)
+
     def set_deployment_thing(self, dep_id, key, value):
         """ update dict of information saved by the user"""
         url = "/deployments/%i/things/set/%s.json" % (dep_id, key)
@@ -632,14 +3400,7 @@ class DexcellRestApi(object):
                 N: nothing
             type_param can be ELECTRICAL, WATER, GAS
         '''
-        new_pod = ''
-        if pod is not None:
-            new_pod = "&pod=" + pod
-        start = start.strftime("%Y%m%d%H%M%S")
-        end = end.strftime("%Y%m%d%H%M%S")
-        url = ["/cost/%i/%s.json?start=%s" % (dev_id, type_param, start)]
-        url.append("&end=%s&applyPattern=%s&period=%s%s" % (end, parameters, time, new_pod))
-        url = "".join(url)
+        url = self._bill_url("/cost/%i/%s.json", dev_id, start, end, type_param, parameters, pod, time)
         bill = self._call_rest(url)
         return bill
 
@@ -652,16 +3413,19 @@ class DexcellRestApi(object):
                 N: nothing
             type_param can be ELECTRICAL, WATER, GAS
         '''
+        url = self._bill_url("/cost/%i/bills/%s.json", sup_id, start, end, type_param, parameters, pod, time)
+        bills = self._call_rest(url)
+        return bills
+
+    def _bill_url(self, path, bill_id, start, end, type_param, parameters, pod, time):
         new_pod = ''
         if pod is not None:
             new_pod = "&pod=" + pod
         start = start.strftime("%Y%m%d%H%M%S")
         end = end.strftime("%Y%m%d%H%M%S")
-        url = ["/cost/%i/bills/%s.json?start=%s" % (sup_id, type_param, start)]
+        url = [path % (bill_id, type_param) + "?start=%s" % start]
         url.append("&end=%s&applyPattern=%s&period=%s%s" % (end, parameters, time, new_pod))
-        url = "".join(url)
-        bills = self._call_rest(url)
-        return bills
+        return "".join(url)
 
     def get_session(self, session_id):
         """ return the session for an app with a concret session_id"""
@@ -670,40 +3434,288 @@ class DexcellRestApi(object):
         self.logger.info('get session: ' + str(response))
         return response
 
-    def get_readings(self, dev_id, s_nid, start, end):
-        """ return array dict with {values, timestamp} """
-        start = self.dxdate(start)
-        end = self.dxdate(end)
-        url = "/devices/%i/%i/readings.json?start=%s&end=%s" % (dev_id, s_nid, start, end)
-        readings = self._call_rest(url)
-        for i in range(0, len(readings)):
-            try:
-                readings[i]['ts'] = datetime.strptime(readings[i]['ts'], "%Y-%m-%d %H:%M:%S")
-                readings[i]['tsutc'] = datetime.strptime(readings[i]['tsutc'], "%Y-%m-%d %H:%M:%S")
-            except KeyError:
-                pass
+    def _parse_reading(self, reading, epoch=False):
+        """ convert the ts and tsutc strings of reading into datetimes, or
+            into seconds since the epoch if epoch is set
+        """
+        try:
+            reading['ts'] = _decode_timestamp(reading['ts'], "%Y-%m-%d %H:%M:%S", epoch)
+            reading['tsutc'] = _decode_timestamp(reading['tsutc'], "%Y-%m-%d %H:%M:%S", epoch)
+        except KeyError:
+            pass
+        return reading
+
+    def _parse_readings(self, readings, epoch=False):
+        """ convert the ts and tsutc strings of readings into datetimes, or
+            into seconds since the epoch if epoch is set
+        """
+        for reading in readings:
+            self._parse_reading(reading, epoch)
         return readings
 
-    def get_readings_new(self, dev_id, param, frequency, operation, start, end):
+    def _parse_cost_reading(self, reading, epoch=False):
+        """ convert the ts string of a cost reading into a datetime, or
+            into seconds since the epoch if epoch is set
+        """
+        try:
+            reading['ts'] = _decode_timestamp(reading['ts'], "%Y/%m/%d %H:%M:%S", epoch)
+        except KeyError:
+            pass
+        return reading
+
+    def _split_range(self, start, end, window, align=1):
+        """ return list of (start, end) windows of at most window covering
+            the interval start - end, with the inner boundaries aligned to
+            multiples of align seconds
+        """
+        window_seconds = int(window.total_seconds()) // align * align
+        if window_seconds <= 0 or end - start <= timedelta(seconds=window_seconds):
+            return [(start, end)]
+        # boundaries are aligned on the wall clock of start and keep its tzinfo,
+        # so timezone aware intervals are split the same way as naive ones
+        start_seconds = calendar.timegm(start.timetuple())
+        origin = start.replace(microsecond=0)
+        boundary = (start_seconds // window_seconds + 1) * window_seconds
+        windows = []
+        window_start = start
+        while True:
+            window_end = origin + timedelta(seconds=boundary - start_seconds)
+            if window_end >= end:
+                windows.append((window_start, end))
+                return windows
+            windows.append((window_start, window_end))
+            window_start = window_end
+            boundary += window_seconds
+
+    def _fetch_windows(self, fetch, start, end, window, workers, align=1, merge=None):
+        """ call fetch(start, end) for every window of the interval using up
+            to workers threads and merge the results in timestamp order with
+            merge, by default _merge_readings
+        """
+        if window is None:
+            return fetch(start, end)
+        windows = self._split_range(start, end, window, align)
+        if len(windows) == 1:
+            return fetch(start, end)
+        results = {}
+        for bounds, readings, error in _imap_unordered(lambda bounds: fetch(*bounds), windows, workers):
+            if error is not None:
+                raise error
+            results[bounds] = readings
+        if merge is None:
+            merge = self._merge_readings
+        return merge(results.pop(bounds) for bounds in windows)
+
+    def _merge_readings(self, parts):
+        """ concatenate the readings lists of consecutive windows dropping
+            the points repeated at the window boundaries
+        """
+        merged = []
+        previous = set()
+        for readings in parts:
+            current = set()
+            for reading in readings:
+                key = (reading.get('ts'), reading.get('tsutc'))
+                if key in previous:
+                    continue
+                current.add(key)
+                merged.append(reading)
+            previous = current
+        return merged
+
+    def _readings_columns(self, readings, keys=('ts', 'tsutc')):
+        """ return dict of array columns of readings with epoch timestamps:
+            int64 keys and float64 for every other field, nan where a
+            reading lacks it or it is not a number. readings without some
+            of the keys are skipped.
+        """
+        times = [(key, array(_INT64_TYPECODE)) for key in keys]
+        values = {}
+        count = 0
+        for reading in readings:
+            try:
+                stamps = [reading[key] for key in keys]
+            except KeyError:
+                continue
+            for (key, column), stamp in izip(times, stamps):
+                column.append(stamp)
+            for key, value in reading.iteritems():
+                if key in keys:
+                    continue
+                column = values.get(key)
+                if column is None:
+                    column = values[key] = array('d', [_NAN]) * count
+                try:
+                    column.append(float(value))
+                except (TypeError, ValueError):
+                    column.append(_NAN)
+            count += 1
+            for column in values.itervalues():
+                if len(column) < count:
+                    column.append(_NAN)
+        values.update(times)
+        return values
+
+    def _merge_columns(self, parts, key='tsutc', dedup=True):
+        """ concatenate the _readings_columns of consecutive windows dropping
+            the rows at the start of a window not after the end of the
+            previous one by key, unless dedup is False
+        """
+        merged = {}
+        count = 0
+        last = None
+        for columns in parts:
+            order = columns[key]
+            skip = 0
+            if dedup and last is not None:
+                while skip < len(order) and order[skip] <= last:
+                    skip += 1
+            for name, column in columns.iteritems():
+                target = merged.get(name)
+                if target is None:
+                    target = merged[name] = array(column.typecode, [_NAN] * count)
+                target.extend(column[skip:])
+            count += len(order) - skip
+            for target in merged.itervalues():
+                if len(target) < count:
+                    target.extend(array('d', [_NAN]) * (count - len(target)))
+            if skip < len(order):
+                last = order[-1]
+        return merged
+
+    def _column_arrays(self, columns, keys=('ts', 'tsutc')):
+        """ return the _readings_columns as NumPy arrays when installed """
+        if numpy is None:
+            return columns
+        return dict((name, numpy.array(column, dtype=numpy.int64 if name in keys else numpy.float64))
+                    for name, column in columns.iteritems())
+
+    def get_readings(self, dev_id, s_nid, start, end, window=None, workers=READINGS_WORKERS,
+                     epoch=False, columns=False):
+        """ return array dict with {values, timestamp}
+
+            with window (a timedelta) the interval is fetched in windows of
+            that length, up to workers of them in parallel. with epoch the
+            timestamps are returned as seconds since the epoch. with columns
+            a dict of int64 epoch timestamp and float64 value columns is
+            returned instead, NumPy arrays when NumPy is installed.
+        """
+        def fetch(start, end):
+            start = self.dxdate(start)
+            end = self.dxdate(end)
+            url = "/devices/%i/%i/readings.json?start=%s&end=%s" % (dev_id, s_nid, start, end)
+            readings = self._call_rest(url)
+            if columns:
+                return self._readings_columns(self._parse_readings(readings, True))
+            return self._parse_readings(readings, epoch)
+
+        if columns:
+            return self._column_arrays(self._fetch_windows(fetch, start, end, window, workers,
+                                                           merge=self._merge_columns))
+        return self._fetch_windows(fetch, start, end, window, workers)
+
+    def get_readings_new(self, dev_id, param, frequency, operation, start, end, window=None,
+                         workers=READINGS_WORKERS, epoch=False, columns=False):
         """ returns array of dict of values from the device dev_id with
             parameter param with a frequency in the interval start - end.
+
+            long intervals of a fixed length frequency are fetched in windows
+            of READINGS_WINDOW_POINTS points, or of window (a timedelta) if
+            given, up to workers of them in parallel. with epoch the
+            timestamps are returned as seconds since the epoch. with columns
+            a dict of int64 epoch timestamp and float64 value columns is
+            returned instead, NumPy arrays when NumPy is installed.
+
+            with a readings store only the parts of the interval not stored
+            yet are requested.
+        """
+        if self.store is not None:
+            series = self.store.series(dev_id, param, frequency, operation)
+            for gap_start, gap_end in self.store.gaps(series, start, end):
+                readings = self._get_readings_new(dev_id, param, frequency, operation, gap_start, gap_end,
+                                                  window, workers, True, False)
+                self.store.add(series, gap_start, gap_end, readings)
+            readings = self.store.readings(series, start, end)
+            if columns:
+                return self._column_arrays(self._readings_columns(readings))
+            if not epoch:
+                for reading in readings:
+                    reading['ts'] = datetime.utcfromtimestamp(reading['ts'])
+                    reading['tsutc'] = datetime.utcfromtimestamp(reading['tsutc'])
+            return readings
+        return self._get_readings_new(dev_id, param, frequency, operation, start, end,
+                                      window, workers, epoch, columns)
+
+    def _get_readings_new(self, dev_id, param, frequency, operation, start, end,
+                          window, workers, epoch, columns):
+        frequency_seconds = self.FREQUENCY_SECONDS.get(str(frequency), 1)
+        if window is None and str(frequency) in self.FREQUENCY_SECONDS:
+            window = timedelta(seconds=frequency_seconds * self.READINGS_WINDOW_POINTS)
+
+        def fetch(start, end):
+            start = self.dxdate(start)
+            end = self.dxdate(end)
+            url = ["/devices/%i/%s/readings.json?" % (dev_id, str(param))]
+            url.append("start=%s&end=%s&frequency=%s&operation=%s" % (start, end, str(frequency), str(operation)))
+            url = "".join(url)
+            readings = self._call_rest(url)
+            if columns:
+                return self._readings_columns(self._parse_readings(readings, True))
+            return self._parse_readings(readings, epoch)
+
+        if columns:
+            return self._column_arrays(self._fetch_windows(fetch, start, end, window, workers,
+                                                           frequency_seconds, self._merge_columns))
+        return self._fetch_windows(fetch, start, end, window, workers, frequency_seconds)
+
+    def get_readings_bulk(self, items, frequency, operation, start, end, workers=8, epoch=False,
+                          columns=False):
+        """ yields (dev_id, param, readings, error) for every (dev_id, param)
+            pair of items as soon as its readings arrive, fetching up to
+            workers of them concurrently. readings are as returned by
+            get_readings_new and error is the exception raised fetching
+            them, or None.
+        """
+        def fetch(item):
+            dev_id, param = item
+            return self.get_readings_new(dev_id, param, frequency, operation, start, end, epoch=epoch,
+                                         columns=columns)
+
+        for item, readings, error in _imap_unordered(fetch, items, workers):
+            if error is not None:
+                self.logger.error('error reading device %s parameter %s: %s' % (str(item[0]), str(item[1]), str(error)))
+            yield item[0], item[1], readings, error
+
+    def iter_readings(self, dev_id, s_nid, start, end, epoch=False):
+        """ yield the readings of get_readings one at a time while the
+            response is still being read, so memory use does not grow with
+            the interval. streamed responses are not cached.
+        """
+        start = self.dxdate(start)
+        end = self.dxdate(end)
+        url = "/devices/%i/%i/readings.json?start=%s&end=%s" % (dev_id, s_nid, start, end)
+        return self._iter_rest(url, epoch)
+
+    def iter_readings_new(self, dev_id, param, frequency, operation, start, end, epoch=False):
+        """ yield the readings of get_readings_new one at a time while the
+            response is still being read, so memory use does not grow with
+            the interval. streamed responses are not cached.
         """
         start = self.dxdate(start)
         end = self.dxdate(end)
         url = ["/devices/%i/%s/readings.json?" % (dev_id, str(param))]
         url.append("start=%s&end=%s&frequency=%s&operation=%s" % (start, end, str(frequency), str(operation)))
-        url = "".join(url)
-        readings = self._call_rest(url)
-        for i in range(0, len(readings)):
-            try:
-                readings[i]['ts'] = datetime.strptime(readings[i]['ts'], "%Y-%m-%d %H:%M:%S")
-                readings[i]['tsutc'] = datetime.strptime(readings[i]['tsutc'], "%Y-%m-%d %H:%M:%S")
-            except KeyError:
-                pass
-        return readings
+        return self._iter_rest("".join(url), epoch)
 
-    def get_cost(self, nid, start, end, energy_type='ELECTRICAL', period='HOUR', grouped=False):
-        """ return array from cost and consumption with timestamp"""
+    def _iter_rest(self, url, epoch):
+        response = self._open_rest(url)
+        try:
+            for reading in _iter_json_array(response):
+                yield self._parse_reading(reading, epoch)
+        finally:
+            response.close()
+
+    def _cost_url(self, nid, start, end, energy_type, period, grouped):
         str_grouped = 'TRUE'
         if not grouped:
             str_grouped = 'FALSE'
@@ -711,14 +3723,285 @@ class DexcellRestApi(object):
         end = self.dxdate(end)
         url = ["/devices/%i/%s/cost.json?" % (nid, energy_type)]
         url.append("start=%s&end=%s&period=%s&grouped=%s" % (start, end, str(period), str_grouped))
-        url = "".join(url)
-        raw_response = self._call_rest(url)
+        return "".join(url)
+
+    def iter_cost(self, nid, start, end, energy_type='ELECTRICAL', period='HOUR', grouped=False,
+                  epoch=False):
+        """ yield the cost and consumption readings of get_cost one at a
+            time while the response is still being read. the periods are
+            not returned, use get_cost for them.
+        """
+        response = self._open_rest(self._cost_url(nid, start, end, energy_type, period, grouped))
+        try:
+            for reading in _iter_json_array(response, 'readings'):
+                yield self._parse_cost_reading(reading, epoch)
+        finally:
+            response.close()
+
+    def get_cost(self, nid, start, end, energy_type='ELECTRICAL', period='HOUR', grouped=False,
+                 epoch=False, columns=False):
+        """ return array from cost and consumption with timestamp, as
+            seconds since the epoch if epoch is set. with columns the
+            readings are returned as a dict of int64 epoch ts and float64
+            columns, NumPy arrays when NumPy is installed.
+        """
+        raw_response = self._call_rest(self._cost_url(nid, start, end, energy_type, period, grouped))
         try:
             readings = raw_response['readings']
             for i in range(0, len(readings)):
-                readings[i]['ts'] = datetime.strptime(readings[i]['ts'], "%Y/%m/%d %H:%M:%S")
+                readings[i]['ts'] = _decode_timestamp(readings[i]['ts'], "%Y/%m/%d %H:%M:%S", epoch or columns)
             periods = raw_response['periods']
+            if columns:
+                readings = self._column_arrays(self._readings_columns(readings, ('ts',)), ('ts',))
             return readings, periods
         except KeyError:
             return []
 
+    def _split_months(self, start, end):
+        """ return list of (start, end) windows of the interval start - end
+            split at the start of every month
+        """
+        windows = []
+        while True:
+            month_end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+            if month_end >= end:
+                windows.append((start, end))
+                return windows
+            windows.append((start, month_end))
+            start = month_end
+
+    def _call_period(self, url, end):
+        """ _call_rest for a period ending at end, whose response is kept in
+            the cache, or in period_cache without one, once it is closed
+        """
+        if end > datetime.now() - timedelta(seconds=self.CLOSED_PERIOD_LAG):
+            return self._call_rest(url)
+        cache = self.cache if self.cache is not None else self.period_cache
+        return self._call_cached(cache, url, self.CLOSED_PERIOD_TTL)
+
+    def _fetch_periods(self, ids, start, end, fetch, workers, name):
+        """ call fetch(id, start, end) for every id and month of the interval
+            using up to workers threads. return dict of (id, window) ->
+            result and dict of id -> exception for the ids that failed
+        """
+        windows = self._split_months(start, end)
+        tasks = [(item_id, window) for item_id in ids for window in windows]
+        results = {}
+        errors = {}
+        for task, result, error in _imap_unordered(lambda task: fetch(task[0], *task[1]), tasks, workers):
+            if error is not None:
+                self.logger.error('error reading %s %s: %s' % (name, str(task[0]), str(error)))
+                errors[task[0]] = error
+            else:
+                results[task] = result
+        return windows, results, errors
+
+    def get_cost_bulk(self, nids, start, end, energy_type='ELECTRICAL', period='HOUR', grouped=False,
+                      workers=8):
+        """ return (columns, errors) with the cost and consumption readings
+            of every device of nids in the interval start - end, fetched
+            month by month with up to workers concurrent calls. columns is a
+            dict of an int64 id column with the device nid, an int64 epoch
+            ts column and a float64 column for every other field, NumPy
+            arrays when NumPy is installed. errors is a dict of nid ->
+            exception for the devices that failed. the months that ended
+            more than CLOSED_PERIOD_LAG seconds ago are cached, so only the
+            open month is requested again.
+        """
+        def fetch(nid, start, end):
+            response = self._call_period(self._cost_url(nid, start, end, energy_type, period, grouped), end)
+            readings = response['readings']
+            for reading in readings:
+                reading['ts'] = _decode_timestamp(reading['ts'], "%Y/%m/%d %H:%M:%S", True)
+            return self._readings_columns(readings, ('ts',))
+
+        windows, results, errors = self._fetch_periods(nids, start, end, fetch, workers, 'cost of device')
+        parts = []
+        for nid in nids:
+            if nid in errors:
+                continue
+            columns = self._merge_columns((results[(nid, window)] for window in windows), 'ts')
+            columns['id'] = array(_INT64_TYPECODE, [nid]) * len(columns['ts'])
+            parts.append(columns)
+        if parts:
+            table = self._merge_columns(parts, 'ts', False)
+        else:
+            table = {'id': array(_INT64_TYPECODE), 'ts': array(_INT64_TYPECODE)}
+        return self._column_arrays(table, ('id', 'ts')), errors
+
+    def get_bills_bulk(self, ids, start, end, supplies=False, type_param='ELECTRICAL', parameters="AAANNN",
+                       pod=None, time='HOUR', workers=8):
+        """ return (rows, errors) with the bills of every device of ids as
+            get_simulated_bill returns them, or of every supply as
+            get_supply_bills does when supplies is set, one per month of the
+            interval start - end, fetched with up to workers concurrent
+            calls. rows is a list of (id, start, end, bill) tuples ordered
+            by id and month, errors a dict of id -> exception for the ones
+            that failed. closed months are cached as in get_cost_bulk.
+        """
+        path = "/cost/%i/bills/%s.json" if supplies else "/cost/%i/%s.json"
+
+        def fetch(bill_id, start, end):
+            url = self._bill_url(path, bill_id, start, end, type_param, parameters, pod, time)
+            return self._call_period(url, end)
+
+        name = 'bills of supply' if supplies else 'bill of device'
+        windows, results, errors = self._fetch_periods(ids, start, end, fetch, workers, name)
+        rows = []
+        for bill_id in ids:
+            if bill_id in errors:
+                continue
+            for window in windows:
+                rows.append((bill_id, window[0], window[1], results[(bill_id, window)]))
+        return rows, errors
+
+
+class DexcellResampler(object):
+    """
+    Resamples raw readings locally, so a series fetched once can be shown
+    at any frequency without asking the api again.
+
+    Readings go into buckets of one of the fixed length frequencies of
+    DexcellRestApi.FREQUENCY_SECONDS, or MONTH or YEAR, by their timestamp
+    field. That is the local ts by default, so days and months follow the
+    timezone and daylight saving changes of the location; use tsutc for
+    UTC buckets. Weeks start on Monday. Every bucket gets one of the
+    OPERATIONS: SUM, AVG, MIN, MAX, LAST or DELTA, the increase of a
+    cumulative counter such as SERVICE_ACTIVE_ENERGY, where a decrease is
+    taken as a counter reset. Without an operation, DELTA is used for the
+    COUNTER_SERVICES and AVG for the rest.
+    """
+
+    OPERATIONS = ('SUM', 'AVG', 'MIN', 'MAX', 'LAST', 'DELTA')
+    CALENDAR_FREQUENCIES = ('MONTH', 'YEAR')
+    # 1970-01-05, the first monday after the epoch
+    WEEK_ORIGIN = 4 * 86400
+
+    S = DexcellServiceMessage
+    COUNTER_SERVICES = frozenset([
+        S.SERVICE_ACTIVE_ENERGY, S.SERVICE_INDUCTIVE_REACTIVE_ENERGY,
+        S.SERVICE_CAPACITIVE_REACTIVE_ENERGY, S.SERVICE_APPARENT_ENERGY,
+        S.SERVICE_GAS_VOLUME, S.SERVICE_GAS_ENERGY, S.SERVICE_FUEL_VOLUME,
+        S.SERVICE_FUEL_ENERGY, S.SERVICE_EXP_ACTIVE_ENERGY,
+        S.SERVICE_EXP_INDUCTIVE_R_ENERGY, S.SERVICE_EXP_CAPACITIVE_R_ENERGY,
+        S.SERVICE_PULSE_COUNTER, S.SERVICE_THERMAL_ENERGY,
+        S.SERVICE_HOT_WATER_VOLUME, S.SERVICE_WATER_VOLUME,
+    ])
+
+    def __init__(self, frequency, operation=None, service=None, value='v', timestamp='ts'):
+        if operation is None:
+            operation = 'DELTA' if service in self.COUNTER_SERVICES else 'AVG'
+        if operation not in self.OPERATIONS:
+            raise ValueError('unknown operation %s' % operation)
+        if frequency not in DexcellRestApi.FREQUENCY_SECONDS and frequency not in self.CALENDAR_FREQUENCIES:
+            raise ValueError('unknown frequency %s' % frequency)
+        self.frequency = frequency
+        self.operation = operation
+        self.value = value
+        self.timestamp = timestamp
+        self.size = DexcellRestApi.FREQUENCY_SECONDS.get(frequency)
+        self.origin = self.WEEK_ORIGIN if frequency == 'WEEK' else 0
+
+    def bucket(self, epoch):
+        """ return the start of the bucket of epoch seconds """
+        if self.frequency == 'MONTH':
+            dt = datetime.utcfromtimestamp(epoch)
+            return calendar.timegm((dt.year, dt.month, 1, 0, 0, 0))
+        if self.frequency == 'YEAR':
+            dt = datetime.utcfromtimestamp(epoch)
+            return calendar.timegm((dt.year, 1, 1, 0, 0, 0))
+        return (epoch - self.origin) // self.size * self.size + self.origin
+
+    def resample(self, readings):
+        """ return the readings resampled, in the shape they came in: a list
+            of {timestamp, value} dicts for a list of readings, as returned
+            by get_readings or get_readings_new, or a dict of columns for
+            the columns=True output. readings must be in timestamp order;
+            the ones without value or timestamp, or with a nan value, are
+            skipped.
+        """
+        if isinstance(readings, dict):
+            if numpy is not None:
+                return self._resample_numpy(readings)
+            starts, values = self._aggregate(izip(readings[self.timestamp], readings[self.value]))
+            return {self.timestamp: array(_INT64_TYPECODE, starts), self.value: array('d', values)}
+        as_datetime = []
+
+        def pairs():
+            for reading in readings:
+                stamp = reading.get(self.timestamp)
+                if isinstance(stamp, datetime):
+                    as_datetime.append(True)
+                    stamp = calendar.timegm(stamp.timetuple())
+                yield stamp, reading.get(self.value)
+
+        starts, values = self._aggregate(pairs())
+        if as_datetime:
+            starts = [datetime.utcfromtimestamp(start) for start in starts]
+        return [{self.timestamp: start, self.value: value} for start, value in izip(starts, values)]
+
+    def _aggregate(self, pairs):
+        """ return the bucket starts and values of (epoch, value) pairs """
+        operation = self.operation
+        starts = []
+        values = []
+        start = None
+        previous = None
+        total = count = 0
+        for stamp, value in pairs:
+            if stamp is None or value is None or value != value:
+                continue
+            bucket = self.bucket(stamp)
+            if bucket != start:
+                if start is not None:
+                    values.append(total / count if operation == 'AVG' else total)
+                start = bucket
+                starts.append(start)
+                count = 0
+                total = 0.0 if operation in ('SUM', 'AVG', 'DELTA') else value
+            count += 1
+            if operation in ('SUM', 'AVG'):
+                total += value
+            elif operation == 'MIN':
+                total = min(total, value)
+            elif operation == 'MAX':
+                total = max(total, value)
+            elif operation == 'LAST':
+                total = value
+            elif previous is not None:
+                total += value - previous if value >= previous else value
+            previous = value
+        if start is not None:
+            values.append(total / count if operation == 'AVG' else total)
+        return starts, values
+
+    def _resample_numpy(self, columns):
+        stamps = numpy.asarray(columns[self.timestamp], dtype=numpy.int64)
+        values = numpy.asarray(columns[self.value], dtype=numpy.float64)
+        valid = ~numpy.isnan(values)
+        stamps = stamps[valid]
+        values = values[valid]
+        if not len(values):
+            return {self.timestamp: stamps, self.value: values}
+        if self.frequency in self.CALENDAR_FREQUENCIES:
+            unit = 'datetime64[M]' if self.frequency == 'MONTH' else 'datetime64[Y]'
+            buckets = stamps.astype('datetime64[s]').astype(unit).astype('datetime64[s]').astype(numpy.int64)
+        else:
+            buckets = (stamps - self.origin) // self.size * self.size + self.origin
+        first = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+        last = numpy.append(first[1:], len(values)) - 1
+        if self.operation == 'SUM':
+            result = numpy.add.reduceat(values, first)
+        elif self.operation == 'AVG':
+            result = numpy.add.reduceat(values, first) / (last - first + 1)
+        elif self.operation == 'MIN':
+            result = numpy.minimum.reduceat(values, first)
+        elif self.operation == 'MAX':
+            result = numpy.maximum.reduceat(values, first)
+        elif self.operation == 'LAST':
+            result = values[last]
+        else:
+            deltas = numpy.diff(values)
+            deltas = numpy.where(deltas < 0, values[1:], deltas)
+            result = numpy.add.reduceat(numpy.concatenate(([0.0], deltas)), first)
+        return {self.timestamp: buckets[first], self.value: result}